@@ -55,15 +55,29 @@ collecting template definitions.
 
 import argparse
 import bz2
+import copy
+import heapq
+import json
 import logging
+import mmap
 import os.path
 import re  # TODO use regex when it will be standard
+import resource
 import sys
+import tempfile
+import threading
 from io import StringIO
-from multiprocessing import Queue, get_context, cpu_count
+from multiprocessing import get_context, cpu_count
+from queue import Empty
 from timeit import default_timer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 
-from .extract import Extractor, ignoreTag, define_template, acceptedNamespaces
+from . import extract
+from .extract import Extractor, ignoreTag, resetIgnoredTags, ignoredTags, define_template
+from .extract import set_template_caches, template_stats, TemplateIndex
+from .multistream import MultistreamReader
+from .templatestore import TemplateStore, dump_key
 
 # ===========================================================================
 
@@ -75,28 +89,6 @@ __version__ = '3.0.6'
 # We include as default Template, when loading external template file.
 knownNamespaces = set(['Template'])
 
-##
-# The namespace used for template definitions
-# It is the name associated with namespace key=10 in the siteinfo header.
-templateNamespace = ''
-templatePrefix = ''
-
-##
-# The namespace used for module definitions
-# It is the name associated with namespace key=828 in the siteinfo header.
-moduleNamespace = ''
-
-# ----------------------------------------------------------------------
-# Modules
-
-# Only minimal support
-# FIXME: import Lua modules.
-
-modules = {
-    'convert': {
-        'convert': lambda x, u, *rest: x + ' ' + u,  # no conversion
-    }
-}
 # ----------------------------------------------------------------------
 # Expand using WikiMedia API
 # import json
@@ -190,18 +182,34 @@ class OutputSplitter():
 tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
 #                    1     2               3      4
 
+# characters escaped in dumps, besides &, < and >
+xmlEntities = {'"': '&quot;'}
 
-def load_templates(file, output_file=None):
+
+def load_templates(file, output_file=None, define=True, options=None,
+                   templates=None, redirects=None):
     """
     Load templates from :param file:.
     :param output_file: file where to save templates and modules.
+    :param define: whether to define the templates, rather than just saving
+        them to :param output_file:.
+    :param options: the ExtractOptions holding the template and module
+        namespaces; the template namespace is recorded there if it is
+        reconstructed from the first title.
+    :param templates: dict where to define templates, by default the one
+        used for extraction.
+    :param redirects: dict where to record template redirects, likewise.
     """
-    global templateNamespace, templatePrefix
-    templatePrefix = templateNamespace + ':'
-    global moduleNamespace, modulePrefix
-    modulePrefix = moduleNamespace + ':'
+    if options is None:
+        options = ExtractOptions()
+    templatePrefix = options.template_namespace + ':'
+    modulePrefix = options.module_namespace + ':'
+    if templates is None:
+        templates = extract.templates
+    if redirects is None:
+        redirects = extract.redirects
     articles = 0
-    templates = 0
+    templateCount = 0
     page = []
     inText = False
     if output_file:
@@ -233,16 +241,17 @@ def load_templates(file, output_file=None):
         elif inText:
             page.append(line)
         elif tag == '/page':
-            if not output_file and not templateNamespace:  # do not know it yet
+            if not output_file and not options.template_namespace:  # do not know it yet
                 # we reconstruct it from the first title
                 colon = title.find(':')
                 if colon > 1:
-                    templateNamespace = title[:colon]
+                    options.template_namespace = title[:colon]
                     templatePrefix = title[:colon + 1]
             # FIXME: should reconstruct also moduleNamespace
             if title.startswith(templatePrefix):
-                define_template(title, page)
-                templates += 1
+                if define:
+                    define_template(title, page, templates, redirects)
+                templateCount += 1
             # save templates and modules to file
             if output_file and (title.startswith(templatePrefix) or
                                 title.startswith(modulePrefix)):
@@ -252,7 +261,7 @@ def load_templates(file, output_file=None):
                 output.write('   <text>')
                 for line in page:
                     output.write(line)
-                output.write('   </text>\n')
+                output.write('</text>\n')
                 output.write('</page>\n')
             page = []
             articles += 1
@@ -260,46 +269,217 @@ def load_templates(file, output_file=None):
                 logging.info("Preprocessed %d pages", articles)
     if output_file:
         output.close()
-        logging.info("Saved %d templates to '%s'", templates, output_file)
-    return templates
+        logging.info("Saved %d templates to '%s'", templateCount, output_file)
+    return templateCount
 
 
-def decode_open(filename, mode='rt', encoding='utf-8'):
+def index_templates(template_file, options):
+    """
+    Index the templates saved in :param template_file: by load_templates(),
+    recording the byte span of the title and text of each in a TemplateIndex.
+    Templates are then defined only when first used, by the processes using them.
+    :param options: the ExtractOptions holding the template namespace, where
+        it is recorded if it is reconstructed from the first title.
+    :return: the TemplateIndex.
+    """
+    templatePrefix = options.template_namespace + ':'
+    index = TemplateIndex(template_file)
+    start = 0
+    offset = 0
+    inText = False
+    with open(template_file, 'rb') as file:
+        for line in file:
+            line_offset = offset
+            offset += len(line)
+            if b'<' not in line:
+                continue
+            line = line.decode('utf-8')
+            m = tagRE.search(line)
+            if not m:
+                continue
+            tag = m.group(2)
+            if tag == 'title':
+                title = m.group(3)
+                title_offset = line_offset + len(line[:m.start(3)].encode('utf-8'))
+            elif tag == 'text':
+                inText = True
+                start = line_offset + len(line[:m.start(3)].encode('utf-8'))
+                if m.lastindex == 4:  # open-close
+                    end = line_offset + len(line[:m.end(3)].encode('utf-8'))
+                    inText = False
+            elif tag == '/text':
+                end = line_offset + len(m.group(1).encode('utf-8'))
+                inText = False
+            elif tag == '/page' and not inText:
+                if not options.template_namespace:  # do not know it yet
+                    # we reconstruct it from the first title
+                    colon = title.find(':')
+                    if colon > 1:
+                        options.template_namespace = title[:colon]
+                        templatePrefix = title[:colon + 1]
+                if title.startswith(templatePrefix):
+                    index.add(title, title_offset, len(title.encode('utf-8')), start, end - start)
+    index.freeze()
+    return index
+
+
+def decode_open(filename, mode='rt', encoding='utf-8', decompress_processes=0):
     """
     Open a file, decode and decompress, depending on extension `gz`, or 'bz2`.
     :param filename: the file to open.
+    :param decompress_processes: number of processes decompressing the streams
+        of a multistream bz2 file in parallel; 0 to decompress sequentially.
     """
     ext = os.path.splitext(filename)[1]
     if ext == '.gz':
         import gzip
         return gzip.open(filename, mode, encoding=encoding)
+    elif ext == '.bz2' and decompress_processes:
+        return MultistreamReader(filename, decompress_processes, encoding=encoding)
     elif ext == '.bz2':
         return bz2.open(filename, mode=mode, encoding=encoding)
     else:
         return open(filename, mode, encoding=encoding)
 
 
-def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count, html_safe):
+class ExtractOptions():
+
     """
-    :param input_file: name of the wikipedia dump file; '-' to read from stdin
-    :param template_file: optional file with template definitions.
-    :param out_file: file where to store extracted data, or '-' for stdout
-    :param file_size: max size of each extracted file, or None for no max (one file)
-    :param file_compress: whether to compress files with bzip.
-    :param process_count: number of extraction processes to spawn.
+    Settings of an extraction run.
+    They are passed to the worker processes, which apply() them before
+    extracting, so that several extractions can run in the same program.
     """
-    global knownNamespaces
-    global templateNamespace, templatePrefix
-    global moduleNamespace, modulePrefix
 
-    urlbase = ''                # This is obtained from <siteinfo>
-
-    input = decode_open(input_file)
+    def __init__(self, keep_links=False, html=False, to_json=False, namespaces=None,
+                 expand_templates=False, template_file=None, html_safe=True,
+                 categories=None, article_timeout=0, timeout_fallback='drop',
+                 quarantine_file=None, decompress_processes=0, batch_size=64,
+                 batch_bytes=1024 * 1024, reorder_window=10000, ordered=True,
+                 template_store=None, snapshot=None, template_cache_size=10000,
+                 expansion_cache_size=10000, page_reader='regex', shards=0):
+        """
+        :param keep_links: whether to preserve links in output.
+        :param html: whether to produce HTML output, subsumes keep_links.
+        :param to_json: whether to write json instead of <doc> output.
+        :param namespaces: accepted namespaces, None for the default ones.
+        :param expand_templates: whether to expand templates, rather than
+            dropping them.
+        :param template_file: file with template definitions, read if it exists,
+            else created when preprocessing the dump.
+        :param html_safe: whether to convert reserved HTML characters to entities.
+        :param categories: localized name of the category namespace, or True
+            to use the name given in the siteinfo of the dump. When set, the
+            categories of each article are collected while its links are
+            replaced, and reported in its header.
+        :param article_timeout: time budget in seconds for each article, 0 for none.
+        :param timeout_fallback: 'drop' to extract slow articles again with
+            templates dropped, 'skip' to leave them out.
+        :param quarantine_file: file listing id, title and timing of the
+            articles exceeding their time budget.
+        :param decompress_processes: number of processes decompressing a
+            multistream bz2 input in parallel; 0 to decompress sequentially.
+        :param batch_size: max number of articles dispatched to a worker at once.
+        :param batch_bytes: max size of the article text dispatched to a worker at once.
+        :param reorder_window: max number of articles dispatched but not yet
+            written out. When the reducer is waiting on a slow article, the
+            mapper stops once this many articles are pending.
+        :param ordered: whether to write articles in dump order; when False
+            they are written as soon as they are extracted.
+        :param template_store: SQLite file storing the parsed templates of the
+            snapshot, shared by the parts of a dump and across runs. Templates
+            are collected by a preprocessing pass only for the parts not in
+            the store yet.
+        :param snapshot: name of the snapshot of the dump, e.g. enwiki-20231101;
+            by default, derived from the name of the dump file, or for
+            'latest' dumps from the checksum list saved next to it.
+        :param template_cache_size: max number of parsed templates cached by
+            each extraction process.
+        :param expansion_cache_size: max number of template expansions
+            memoized by each extraction process.
+        :param page_reader: how pages are read from the dump: 'regex' to scan
+            it line by line, 'xml' to parse it with expat.
+        :param shards: number of byte ranges an uncompressed dump is split
+            into, each extracted by a worker into an output shard of its
+            own; 0 to extract the dump as a whole.
+        """
+        self.keep_links = keep_links or html
+        self.html = html
+        self.to_json = to_json
+        self.namespaces = namespaces
+        self.expand_templates = expand_templates
+        self.template_file = template_file
+        self.html_safe = html_safe
+        self.categories = categories
+        self.article_timeout = article_timeout
+        self.timeout_fallback = timeout_fallback
+        self.quarantine_file = quarantine_file
+        self.decompress_processes = decompress_processes
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.reorder_window = reorder_window
+        self.ordered = ordered
+        self.template_store = template_store
+        self.snapshot = snapshot
+        self.template_cache_size = template_cache_size
+        self.expansion_cache_size = expansion_cache_size
+        self.page_reader = page_reader
+        self.shards = shards
+        # file holding the templates of the dump, removed after extraction
+        self.temporary_template_file = None
+        # filled from <siteinfo> by process_dump()
+        self.known_namespaces = set(['Template'])
+        self.template_namespace = ''
+        self.module_namespace = ''
+        self.category_namespace = ''
+        self.dbname = ''
+        # TemplateIndex of the templates of the dump, filled by open_dump()
+        self.template_index = None
+
+    def accepted_namespaces(self):
+        """
+        :return: the set of namespaces of the pages and links kept.
+        """
+        return set(self.namespaces or extract.defaultNamespaces)
 
-    # collect siteinfo
+    def apply(self):
+        """
+        Configure the extractor of the current process with these options.
+        """
+        Extractor.keepLinks = self.keep_links
+        Extractor.HtmlFormatting = self.html
+        Extractor.to_json = self.to_json
+        Extractor.expand_templates = self.expand_templates
+        Extractor.categoryNamespaces = set()
+        if self.categories:
+            # links to the canonical namespace are valid in any language
+            names = ['Category', self.category_namespace]
+            if self.categories is not True:
+                names.append(self.categories)
+            Extractor.categoryNamespaces = set(name.lower() for name in names if name)
+        Extractor.timeout = self.article_timeout
+        Extractor.timeoutFallback = self.timeout_fallback
+        extract.acceptedNamespaces = self.accepted_namespaces()
+        extract.knownNamespaces = self.known_namespaces
+        if self.template_namespace:
+            extract.templatePrefix = self.template_namespace + ':'
+        extract.templateIndex = self.template_index
+        if self.expand_templates and self.template_store:
+            extract.templateStore = TemplateStore(self.template_store)
+        set_template_caches(self.template_cache_size, self.expansion_cache_size)
+        resetIgnoredTags()
+        for tag in ignoredTags:
+            ignoreTag(tag)
+        if not self.keep_links:
+            ignoreTag('a')
+
+
+def read_siteinfo(input, options):
+    """
+    Read the <siteinfo> header of a dump, recording namespaces in :param options:.
+    :return: the urlbase of the wiki.
+    """
+    urlbase = ''
     for line in input:
-        line = line #.decode('utf-8')
         m = tagRE.search(line)
         if not m:
             continue
@@ -309,86 +489,118 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
             # /mediawiki/siteinfo/base
             base = m.group(3)
             urlbase = base[:base.rfind("/")]
+        elif tag == 'dbname':
+            options.dbname = m.group(3)
         elif tag == 'namespace':
-            knownNamespaces.add(m.group(3))
+            options.known_namespaces.add(m.group(3))
             if re.search('key="10"', line):
-                templateNamespace = m.group(3)
-                templatePrefix = templateNamespace + ':'
+                options.template_namespace = m.group(3)
             elif re.search('key="828"', line):
-                moduleNamespace = m.group(3)
-                modulePrefix = moduleNamespace + ':'
+                options.module_namespace = m.group(3)
+            elif re.search('key="14"', line):
+                options.category_namespace = m.group(3)
         elif tag == '/siteinfo':
             break
+    return urlbase
+
 
-    if expand_templates:
-        # preprocess
+def extract_dump(input_file, out_file, processes=None, options=None, **kwargs):
+    """
+    Extract the text of the articles of a Wikipedia dump.
+    :param input_file: name of the wikipedia dump file, possibly compressed.
+    :param out_file: file where to store extracted data, or '-' for stdout.
+        It is written by a forked process: use extract_documents() to get
+        the articles in this process instead.
+    :param processes: number of extraction processes, by default one less
+        than the number of CPUs.
+    :param options: an ExtractOptions; if None, one is built from :param kwargs:.
+        With options.shards, the output is written to shards of
+        :param out_file: instead, see process_shards().
+    :return: a dict of statistics: number of 'articles', 'bytes' of output,
+        'seconds' spent.
+    """
+    if options is None:
+        options = ExtractOptions(**kwargs)
+    if processes is None:
+        processes = cpu_count() - 1
+    if options.shards:
+        return process_shards(input_file, out_file, processes, options)
+    return process_dump(input_file, out_file, processes, options)
+
+
+def open_dump(input_file, options):
+    """
+    Open a dump, reading its siteinfo into :param options: and collecting
+    template definitions if templates are to be expanded.
+    :return: the dump positioned past <siteinfo>, and the urlbase of the wiki.
+    """
+    input = decode_open(input_file, decompress_processes=options.decompress_processes)
+
+    # collect siteinfo
+    urlbase = read_siteinfo(input, options)
+
+    if options.expand_templates and options.template_store:
+        store = TemplateStore(options.template_store)
+        part = os.path.basename(input_file)
+        parts = store.open(options.snapshot or dump_key(input_file, options.dbname))
+        if part in parts:
+            logging.info("Using %d templates from '%s'", len(store), options.template_store)
+            store.close()
+            return input, urlbase
+        if input_file == '-':
+            # can't scan then reset stdin
+            raise ValueError("to use a template store with stdin dump, its templates must be stored already")
+        # articles may use templates defined in this part only, so they are
+        # stored before extracting it
         template_load_start = default_timer()
-        if template_file and os.path.exists(template_file):
-            logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", template_file)
-            file = decode_open(template_file)
-            templates = load_templates(file)
-            file.close()
-        else:
+        logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
+        # workers read them from the store
+        templates = {}
+        redirects = {}
+        load_templates(input, options=options, templates=templates, redirects=redirects)
+        store.add(templates, redirects, part)
+        store.close()
+        input.close()
+        input = decode_open(input_file, decompress_processes=options.decompress_processes)
+        read_siteinfo(input, options)
+        logging.info("Added templates of '%s' to template store '%s' in %.1fs", part,
+                     options.template_store, default_timer() - template_load_start)
+    elif options.expand_templates:
+        # preprocess: templates are saved to template_file, and just indexed
+        # there, they are defined on first use
+        template_file = options.template_file
+        template_load_start = default_timer()
+        if not (template_file and os.path.exists(template_file)):
             if input_file == '-':
                 # can't scan then reset stdin; must error w/ suggestion to specify template_file
                 raise ValueError("to use templates with stdin dump, must supply explicit template-file")
+            if not template_file:
+                fd, template_file = tempfile.mkstemp(prefix='templates-', suffix='.xml')
+                os.close(fd)
+                options.temporary_template_file = template_file
             logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-            templates = load_templates(input, template_file)
+            load_templates(input, template_file, define=False, options=options)
             input.close()
-            input = decode_open(input_file)
+            input = decode_open(input_file, decompress_processes=options.decompress_processes)
+            read_siteinfo(input, options)
+        options.template_index = index_templates(template_file, options)
         template_load_elapsed = default_timer() - template_load_start
-        logging.info("Loaded %d templates in %.1fs", templates, template_load_elapsed)
-
-    if out_file == '-':
-        output = sys.stdout
-        if file_compress:
-            logging.warn("writing to stdout, so no output compression (use an external tool)")
-    else:
-        #nextFile = NextFile(out_file)
-        #output = OutputSplitter(nextFile, file_size, file_compress)
-        output = open(out_file,'w')
+        logging.info("Indexed %d templates in %.1fs", len(options.template_index), template_load_elapsed)
 
-    # process pages
-    logging.info("Starting page extraction from %s.", input_file)
-    extract_start = default_timer()
+    return input, urlbase
 
-    # Parallel Map/Reduce:
-    # - pages to be processed are dispatched to workers
-    # - a reduce process collects the results, sort them and print them.
-
-    # fixes MacOS error: TypeError: cannot pickle '_io.TextIOWrapper' object
-    Process = get_context("fork").Process
-
-    maxsize = 10 * process_count
-    # output queue
-    output_queue = Queue(maxsize=maxsize)
-
-    # Reduce job that sorts and prints output
-    reduce = Process(target=reduce_process, args=(output_queue, output))
-    reduce.start()
-
-    # initialize jobs queue
-    jobs_queue = Queue(maxsize=maxsize)
-
-    # start worker processes
-    logging.info("Using %d extract processes.", process_count)
-    workers = []
-    for _ in range(max(1, process_count)):
-        extractor = Process(target=extract_process,
-                            args=(jobs_queue, output_queue, html_safe))
-        extractor.daemon = True  # only live while parent process lives
-        extractor.start()
-        workers.append(extractor)
-
-    # Mapper process
 
+def read_pages(input):
+    """
+    Scan the pages of a dump, positioned past <siteinfo>, line by line.
+    :return: an iterator over (id, revid, title, redirect, page), where page
+        is a list of lines.
+    """
     # we collect individual lines, since str.join() is significantly faster
     # than concatenation
     page = []
     id = ''
     revid = ''
-    last_id = ''
-    ordinal = 0  # page count
     inText = False
     redirect = False
     for line in input:
@@ -405,7 +617,8 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
             redirect = False
         elif tag == 'id' and not id:
             id = m.group(3)
-        elif tag == 'id' and id: # <revision> <id></id> </revision>
+        elif tag == 'id' and not revid:  # <revision> <id></id> </revision>
+            # ignore <contributor> <id></id> </contributor>
             revid = m.group(3)
         elif tag == 'title':
             title = m.group(3)
@@ -424,76 +637,561 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
         elif inText:
             page.append(line)
         elif tag == '/page':
-            colon = title.find(':')
-            if (colon < 0 or (title[:colon] in acceptedNamespaces) and id != last_id and
-                    not redirect and not title.startswith(templateNamespace)):
-                job = (id, revid, urlbase, title, page, ordinal)
-                jobs_queue.put(job)  # goes to any available extract_process
-                last_id = id
-                ordinal += 1
+            yield (id, revid, title, redirect, page)
             id = ''
             revid = ''
             page = []
 
+
+def parse_pages(input, chunk_size=1024 * 1024):
+    """
+    Parse the pages of a dump, positioned past <siteinfo>, with expat.
+    Elements are cleared once read, so that memory stays flat.
+    :return: an iterator over (id, revid, title, redirect, page), like
+        read_pages(): title and text are escaped again as in the dump, since
+        extraction expects them so.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    # the root element was read along with <siteinfo>
+    parser.feed('<mediawiki>')
+    root = None
+    if hasattr(input, 'read'):
+        chunks = iter(lambda: input.read(chunk_size), '')
+    else:
+        chunks = chunked(input, chunk_size)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if root is None:
+                root = elem
+            elif event == 'end' and elem.tag == 'page':
+                revision = elem.find('revision')
+                revid = revision.findtext('id', '') if revision is not None else ''
+                text = revision.findtext('text', '') if revision is not None else ''
+                yield (elem.findtext('id', ''), revid,
+                       escape(elem.findtext('title', ''), xmlEntities),
+                       elem.find('redirect') is not None,
+                       [escape(text, xmlEntities)])
+                root.clear()
+
+
+def chunked(lines, size):
+    """
+    :return: an iterator over strings of about :param size: characters,
+        joining :param lines:.
+    """
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def pages_from(input, options):
+    """
+    Scan the pages of a dump, positioned past <siteinfo>, with the page
+    reader chosen by options.page_reader.
+    :return: an iterator over (id, revid, title, page) of the articles to
+        extract, where page is a list of lines.
+    """
+    pages = parse_pages(input) if options.page_reader == 'xml' else read_pages(input)
+    # options are not applied in the process mapping pages
+    accepted = options.accepted_namespaces()
+    last_id = ''
+    for id, revid, title, redirect, page in pages:
+        colon = title.find(':')
+        if (colon < 0 or (title[:colon] in accepted) and id != last_id and
+                not redirect and not title.startswith(options.template_namespace)):
+            yield (id, revid, title, page)
+            last_id = id
+
+
+def map_pages(input, urlbase, jobs_queue, output_queue, window, workers, options,
+              stop=None, stats_queue=None):
+    """
+    Dispatch the pages of :param input: to the workers in batches, then wait
+    for them to finish and signal the end of work to the reducer.
+    :param window: semaphore with a slot for each article in flight.
+    :param stop: an Event telling to stop dispatching.
+    :param stats_queue: where workers put their template statistics on exit.
+    :return: the number of articles dispatched, and the list of template
+        statistics of the workers.
+    """
+    # Jobs are dispatched in batches, to amortize pickling and pipe transfer
+    # over many (mostly small) articles.
+    batch = []
+    batch_len = 0
+    ordinal = 0  # page count
+    for id, revid, title, page in pages_from(input, options):
+        if stop and stop.is_set():
+            break
+        job = (id, revid, urlbase, title, page, ordinal)
+        if not window.acquire(False):
+            # window full: send what we hold, since the reducer may
+            # be waiting for it, then wait for a slot
+            if batch:
+                jobs_queue.put(batch)
+                batch = []
+                batch_len = 0
+            window.acquire()
+        batch.append(job)
+        batch_len += sum(len(line) for line in page)
+        if len(batch) >= options.batch_size or batch_len >= options.batch_bytes:
+            jobs_queue.put(batch)  # goes to any available extract_process
+            batch = []
+            batch_len = 0
+        ordinal += 1
+
     input.close()
+    if batch:
+        jobs_queue.put(batch)
 
     # signal termination
     for _ in workers:
         jobs_queue.put(None)
+    # collect statistics before joining, so that workers can flush them
+    stats = [stats_queue.get() for _ in workers] if stats_queue else []
     # wait for workers to terminate
     for w in workers:
         w.join()
 
     # signal end of work to reduce process
     output_queue.put(None)
-    # wait for it to finish
+
+    finish_templates(options)
+    return ordinal, stats
+
+
+def finish_templates(options):
+    """
+    Release the templates of an extraction run, once workers are done.
+    """
+    if options.template_index:
+        options.template_index.close()
+        options.template_index = None
+    if options.temporary_template_file:
+        os.remove(options.temporary_template_file)
+
+
+def start_workers(context, process_count, options, documents=False, output_bytes=None,
+                  stats_queue=None):
+    """
+    Start :param process_count: extraction processes.
+    :return: the jobs queue, the output queue and the list of workers.
+    """
+    maxsize = 10 * process_count
+    jobs_queue = context.Queue(maxsize=maxsize)
+    output_queue = context.Queue(maxsize=maxsize)
+    logging.info("Using %d extract processes.", process_count)
+    workers = []
+    for _ in range(max(1, process_count)):
+        extractor = context.Process(target=extract_process,
+                                    args=(jobs_queue, output_queue, options, output_bytes,
+                                          documents, stats_queue))
+        extractor.daemon = True  # only live while parent process lives
+        extractor.start()
+        workers.append(extractor)
+    return jobs_queue, output_queue, workers
+
+
+def process_dump(input_file, out_file, process_count, options):
+    """
+    :param input_file: name of the wikipedia dump file; '-' to read from stdin
+    :param out_file: file where to store extracted data, or '-' for stdout.
+        It is written by a forked process: use extract_documents() to get
+        the articles in this process instead.
+    :param process_count: number of extraction processes to spawn.
+    :param options: the ExtractOptions of this run.
+    :return: a dict of statistics: 'articles', 'bytes', 'seconds'.
+    """
+    if not isinstance(out_file, str):
+        raise ValueError("extraction needs an output file name, or '-' for stdout")
+
+    # siteinfo is recorded in a copy, options may be shared by other runs
+    options = copy.copy(options)
+    options.known_namespaces = set(options.known_namespaces)
+
+    input, urlbase = open_dump(input_file, options)
+
+    if out_file == '-':
+        output = sys.stdout
+        # what is buffered would be flushed again by the reducer
+        output.flush()
+    else:
+        #nextFile = NextFile(out_file)
+        #output = OutputSplitter(nextFile, file_size, file_compress)
+        output = open(out_file,'w')
+
+    # process pages
+    logging.info("Starting page extraction from %s.", input_file)
+    extract_start = default_timer()
+
+    # Parallel Map/Reduce:
+    # - pages to be processed are dispatched to workers
+    # - a reduce process collects the results, sort them and print them.
+
+    # fixes MacOS error: TypeError: cannot pickle '_io.TextIOWrapper' object
+    context = get_context("fork")
+
+    # slots for articles in flight, released by the reducer once written
+    window = context.Semaphore(options.reorder_window)
+
+    # bytes of extracted text, summed by the workers
+    output_bytes = context.Value('q', 0)
+
+    # template cache statistics of each worker
+    stats_queue = context.Queue() if options.expand_templates else None
+
+    jobs_queue, output_queue, workers = start_workers(context, process_count, options,
+                                                      output_bytes=output_bytes,
+                                                      stats_queue=stats_queue)
+
+    # Reduce job that sorts and prints output
+    reduce = context.Process(target=reduce_process, args=(output_queue, output, window, options.ordered))
+    reduce.start()
+
+    # Mapper process
+    ordinal, worker_stats = map_pages(input, urlbase, jobs_queue, output_queue, window,
+                                      workers, options, stats_queue=stats_queue)
+
+    # wait for the reducer to finish
     reduce.join()
 
     if output != sys.stdout:
         output.close()
     extract_duration = default_timer() - extract_start
     extract_rate = ordinal / extract_duration
-    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
-                 process_count, ordinal, extract_duration, extract_rate)
+    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s, batches of %d articles or %d bytes)",
+                 process_count, ordinal, extract_duration, extract_rate, options.batch_size, options.batch_bytes)
+    for i, stats in enumerate(worker_stats):
+        log_template_stats('Process %d' % (i + 1), stats)
+    stats = {'articles': ordinal, 'bytes': output_bytes.value, 'seconds': extract_duration}
+    if worker_stats:
+        stats['templates'] = worker_stats
+    return stats
+
+
+# ----------------------------------------------------------------------
+# Sharded extraction
+
+
+def shard_spans(input_file, shards):
+    """
+    Split the pages of the uncompressed dump :param input_file: into about
+    :param shards: byte ranges of equal size, each starting at a line with
+    a <page> tag.
+    :return: the list of (start, end) byte spans.
+    """
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+        first = dump.find(b'<page>')
+        if first < 0:
+            return []
+        first = dump.rfind(b'\n', 0, first) + 1
+        end = dump.rfind(b'</mediawiki>')
+        if end < first:
+            end = len(dump)
+        offsets = [first]
+        for i in range(1, shards):
+            offset = dump.find(b'<page>', first + (end - first) * i // shards, end)
+            if offset < 0:
+                break
+            offset = dump.rfind(b'\n', 0, offset) + 1
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    return list(zip(offsets, offsets[1:] + [end]))
+
+
+def shard_lines(input_file, start, end):
+    """
+    :return: an iterator over the lines of :param input_file: between byte
+        offsets :param start: and :param end:, read from a memory mapping.
+    """
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+        dump.seek(start)
+        while dump.tell() < end:
+            yield dump.readline().decode('utf-8')
+
+
+def extract_shard(job):
+    """
+    Extract the pages in a byte range of a dump into a shard of the output.
+    :param job: tuple (input_file, start, end, urlbase, shard_file, options).
+    :return: the number of articles and the size in bytes of the shard.
+    """
+    input_file, start, end, urlbase, shard_file, options = job
+    articles = 0
+    with open(shard_file, 'w') as output:
+        for id, revid, title, page in pages_from(shard_lines(input_file, start, end), options):
+            extractor = Extractor(id, revid, urlbase, title, page)
+            extractor.extract(output, options.html_safe)
+            articles += 1
+            if extractor.timed_out and options.quarantine_file:
+                quarantine(options.quarantine_file, extractor)
+    return articles, os.path.getsize(shard_file)
+
+
+def process_shards(input_file, out_file, process_count, options):
+    """
+    Extract an uncompressed dump split into byte ranges, each parsed and
+    extracted by a worker into a shard of its own, named after
+    :param out_file: with the number of the shard, e.g. text-00001.
+    The list of shards, in dump order, is written to the manifest file
+    :param out_file:.manifest, a json record per shard.
+    :param process_count: number of extraction processes to spawn.
+    :param options: the ExtractOptions of this run.
+    :return: a dict of statistics: 'articles', 'bytes', 'seconds', 'shards'.
+    """
+    if input_file == '-' or os.path.splitext(input_file)[1] in ('.bz2', '.gz'):
+        raise ValueError("sharded extraction needs an uncompressed dump file")
+    if not isinstance(out_file, str) or out_file == '-':
+        raise ValueError("sharded extraction needs an output file name")
+
+    # siteinfo is recorded in a copy, options may be shared by other runs
+    options = copy.copy(options)
+    options.known_namespaces = set(options.known_namespaces)
+
+    input, urlbase = open_dump(input_file, options)
+    input.close()
+
+    logging.info("Starting sharded page extraction from %s.", input_file)
+    extract_start = default_timer()
+
+    spans = shard_spans(input_file, options.shards)
+    # workers get the template index when forked, by applying options: the
+    # jobs are pickled, and carry a copy without it
+    job_options = copy.copy(options)
+    job_options.template_index = None
+    jobs = [(input_file, start, end, urlbase, '%s-%05d' % (out_file, i + 1), job_options)
+            for i, (start, end) in enumerate(spans)]
+    articles = 0
+    size = 0
+    context = get_context("fork")
+    with context.Pool(max(1, process_count), initializer=options.apply) as pool, \
+         open(out_file + '.manifest', 'w') as manifest:
+        for job, (shard_articles, shard_size) in zip(jobs, pool.imap(extract_shard, jobs)):
+            record = {'file': os.path.basename(job[4]), 'start': job[1], 'end': job[2],
+                      'articles': shard_articles, 'bytes': shard_size}
+            manifest.write(json.dumps(record) + '\n')
+            articles += shard_articles
+            size += shard_size
+    finish_templates(options)
+
+    extract_duration = default_timer() - extract_start
+    logging.info("Finished %d-process extraction of %d articles in %d shards in %.1fs (%.1f art/s)",
+                 process_count, articles, len(jobs), extract_duration, articles / extract_duration)
+    return {'articles': articles, 'bytes': size, 'seconds': extract_duration, 'shards': len(jobs)}
+
+
+def read_manifest(out_file):
+    """
+    :return: the list of the records of the shards of :param out_file:, in
+        dump order, with the path of each shard file.
+    """
+    dirname = os.path.dirname(out_file)
+    shards = []
+    with open(out_file + '.manifest') as manifest:
+        for line in manifest:
+            record = json.loads(line)
+            record['file'] = os.path.join(dirname, record['file'])
+            shards.append(record)
+    return shards
+
+
+def log_template_stats(name, stats):
+    """
+    Log the template cache statistics and the memory usage of an extraction
+    process.
+    """
+    for cache in ('templates', 'expansions'):
+        counts = stats[cache]
+        lookups = counts['hits'] + counts['misses']
+        logging.info("%s: %s cache %d hits, %d misses (%.1f%% hit rate), %d evictions",
+                     name, cache, counts['hits'], counts['misses'],
+                     100.0 * counts['hits'] / lookups if lookups else 0.0, counts['evictions'])
+    logging.info("%s: %.1fs expanding templates", name, stats['seconds'])
+    for when in ('start', 'end'):
+        rss, private = stats['memory'][when]
+        if private is None:
+            logging.info("%s: peak RSS %.1f MB at %s", name, rss / 2**20, when)
+        else:
+            logging.info("%s: RSS %.1f MB (%.1f MB private) at %s",
+                         name, rss / 2**20, private / 2**20, when)
+
+
+def extract_documents(input_file, processes=None, options=None, **kwargs):
+    """
+    Extract the articles of a Wikipedia dump in a pool of processes, without
+    writing them out.
+    :param input_file: name of the wikipedia dump file, possibly compressed.
+    :param processes: number of extraction processes, by default one less
+        than the number of CPUs.
+    :param options: an ExtractOptions; if None, one is built from :param kwargs:.
+        Output format settings are ignored.
+    :return: an iterator over the extracted Documents, in dump order unless
+        options.ordered is False.
+    """
+    if options is None:
+        options = ExtractOptions(**kwargs)
+    if processes is None:
+        processes = cpu_count() - 1
+    options = copy.copy(options)
+    options.known_namespaces = set(options.known_namespaces)
+
+    input, urlbase = open_dump(input_file, options)
+
+    context = get_context("fork")
+    window = context.Semaphore(options.reorder_window)
+    jobs_queue, output_queue, workers = start_workers(context, processes, options, documents=True)
+
+    # the mapper runs in a thread, while the caller consumes documents
+    stop = threading.Event()
+    mapper = threading.Thread(target=map_pages,
+                              args=(input, urlbase, jobs_queue, output_queue, window,
+                                    workers, options, stop))
+    mapper.daemon = True
+    mapper.start()
+
+    ordering_buffer = []  # heap of collected (ordinal, document)
+    next_ordinal = 0
+    try:
+        while True:
+            if ordering_buffer and ordering_buffer[0][0] == next_ordinal:
+                document = heapq.heappop(ordering_buffer)[1]
+                next_ordinal += 1
+                window.release()
+                if document:
+                    yield document
+            else:
+                results = output_queue.get()
+                if not results:
+                    break
+                if options.ordered:
+                    for pair in results:
+                        heapq.heappush(ordering_buffer, pair)
+                else:
+                    for _, document in results:
+                        window.release()
+                        if document:
+                            yield document
+    finally:
+        if mapper.is_alive():
+            # the caller stopped early: stop the workers and unblock the mapper
+            stop.set()
+            for w in workers:
+                w.terminate()
+            while mapper.is_alive():
+                window.release()
+                for queue in (jobs_queue, output_queue):
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        pass
+                mapper.join(0.01)
+            # nobody reads what is left in the queues: do not wait on exit
+            # for it to be flushed
+            jobs_queue.cancel_join_thread()
+            output_queue.cancel_join_thread()
 
 
 # ----------------------------------------------------------------------
 # Multiprocess support
 
 
-def extract_process(jobs_queue, output_queue, html_safe):
+def extract_process(jobs_queue, output_queue, options, output_bytes=None, documents=False,
+                    stats_queue=None):
     """Pull tuples of raw page content, do CPU/regex-heavy fixup, push finished text
     :param jobs_queue: where to get jobs.
     :param output_queue: where to queue extracted text for output.
-    :html_safe: whether to convert entities in text to HTML.
+    :param options: the ExtractOptions of the run.
+    :param output_bytes: shared counter of the bytes of extracted text.
+    :param documents: whether to push Documents (None for skipped articles)
+        instead of text.
+    :param stats_queue: where to put the template cache statistics on exit.
     """
+    options.apply()
+    start_memory = process_memory()
     while True:
-        job = jobs_queue.get()  # job is (id, revid, urlbase, title, page, ordinal)
-        if job:
-            out = StringIO()  # memory buffer
-            Extractor(*job[:-1]).extract(out, html_safe)  # (id, urlbase, title, page)
-            text = out.getvalue()
-            output_queue.put((job[-1], text))  # (ordinal, extracted_text)
-            out.close()
+        batch = jobs_queue.get()  # list of jobs (id, revid, urlbase, title, page, ordinal)
+        if batch:
+            results = []
+            size = 0
+            for job in batch:
+                extractor = Extractor(*job[:-1])  # (id, urlbase, title, page)
+                if documents:
+                    result = extractor.document(options.html_safe)
+                else:
+                    out = StringIO()  # memory buffer
+                    extractor.extract(out, options.html_safe)
+                    result = out.getvalue()
+                    size += len(result.encode('utf-8'))
+                    out.close()
+                results.append((job[-1], result))  # (ordinal, extracted_text)
+                if extractor.timed_out and options.quarantine_file:
+                    quarantine(options.quarantine_file, extractor)
+            output_queue.put(results)
+            if output_bytes is not None:
+                with output_bytes.get_lock():
+                    output_bytes.value += size
         else:
             break
+    if stats_queue:
+        stats = template_stats()
+        stats['memory'] = {'start': start_memory, 'end': process_memory()}
+        stats_queue.put(stats)
+
+
+def process_memory():
+    """
+    :return: the resident memory of this process and the part of it written
+        by this process only, i.e. not shared with the other processes, in
+        bytes. Where /proc is missing, the peak resident memory and None.
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            sizes = dict(line.split(':', 1) for line in f if line.endswith('kB\n'))
+        return int(sizes['Rss'].split()[0]) * 1024, int(sizes['Private_Dirty'].split()[0]) * 1024
+    except (OSError, KeyError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, None
+
+
+def quarantine(filename, extractor):
+    """
+    Append to :param filename: a tab separated record of an article that
+    exceeded its time budget: id, title, seconds, action taken.
+    Records are short, so appends from several workers do not interleave.
+    """
+    action = 'skipped' if extractor.skipped else 'templates dropped'
+    with open(filename, 'a') as f:
+        f.write('%s\t%s\t%.2f\t%s\n' % (extractor.id, extractor.title,
+                                          extractor.elapsed, action))
 
 
-def reduce_process(output_queue, output):
+def reduce_process(output_queue, output, window=None, ordered=True):
     """Pull finished article text, write series of files (or stdout)
-    :param output_queue: text to be output.
+    :param output_queue: batches of (ordinal, text) to be output.
     :param output: file object where to print.
+    :param window: semaphore with a slot for each article in flight, released
+        when the article is written.
+    :param ordered: whether to write articles in ordinal order.
     """
 
     interval_start = default_timer()
     period = 100000
-    # FIXME: use a heap
-    ordering_buffer = {}  # collected pages
+    ordering_buffer = []  # heap of collected (ordinal, text)
     next_ordinal = 0  # sequence number of pages
+    written = 0
     while True:
-        if next_ordinal in ordering_buffer:
-            output.write(ordering_buffer.pop(next_ordinal))
+        if ordering_buffer and ordering_buffer[0][0] == next_ordinal:
+            output.write(heapq.heappop(ordering_buffer)[1])
             next_ordinal += 1
+            if window:
+                window.release()
             # progress report
             if next_ordinal % period == 0:
                 interval_rate = period / (default_timer() - interval_start)
@@ -502,11 +1200,25 @@ def reduce_process(output_queue, output):
                 interval_start = default_timer()
         else:
             # mapper puts None to signal finish
-            pair = output_queue.get()
-            if not pair:
+            results = output_queue.get()
+            if not results:
                 break
-            ordinal, text = pair
-            ordering_buffer[ordinal] = text
+            if ordered:
+                for pair in results:
+                    heapq.heappush(ordering_buffer, pair)
+            else:
+                for _, text in results:
+                    output.write(text)
+                    if window:
+                        window.release()
+                written += len(results)
+                if written // period != (written - len(results)) // period:
+                    interval_rate = period / (default_timer() - interval_start)
+                    logging.info("Extracted %d articles (%.1f art/s)",
+                                 written, interval_rate)
+                    interval_start = default_timer()
+    # we run in a forked process, whose buffers are not flushed on exit
+    output.flush()
 
 
 # ----------------------------------------------------------------------
@@ -515,28 +1227,36 @@ def reduce_process(output_queue, output):
 minFileSize = 200 * 1024
 
 
-def process_wiki(dumpfile=None, outfile=None, htmlsafe=False, templates=False):
-    global urlbase, acceptedNamespaces
-    global expand_templates, templateCache
-
-    sys.argv = [sys.argv[0]]
-    sys.argv.extend(['-o', outfile])
-    sys.argv.extend(['--html-safe', 'False'])
-    sys.argv.extend(['--no-templates'])
-    sys.argv.extend([dumpfile])
-    parser = argparse.ArgumentParser(prog=os.path.basename("/wikiextractor/WikiExtractor.py"),
+def process_wiki(dumpfile=None, outfile=None, htmlsafe=True, templates=False, categories=None,
+                 decompress_processes=0, batch_size=64, batch_bytes=1024 * 1024,
+                 reorder_window=10000, ordered=True, article_timeout=0,
+                 timeout_fallback='drop', quarantine_file=None, processes=None):
+    """
+    Extract :param dumpfile: to :param outfile: with the settings used by wikinlp.
+    See ExtractOptions for the parameters.
+    :return: the statistics of extract_dump().
+    """
+    options = ExtractOptions(html_safe=htmlsafe, expand_templates=templates,
+                             categories=categories,
+                             decompress_processes=decompress_processes,
+                             batch_size=batch_size, batch_bytes=batch_bytes,
+                             reorder_window=reorder_window, ordered=ordered,
+                             article_timeout=article_timeout,
+                             timeout_fallback=timeout_fallback,
+                             quarantine_file=quarantine_file)
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    return extract_dump(dumpfile, outfile, processes, options)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=__doc__)
     parser.add_argument("input",
                         help="XML wiki dump file")
     groupO = parser.add_argument_group('Output')
     groupO.add_argument("-o", "--output", default="text",
-                        help="directory for extracted files (or '-' for dumping to stdout)")
-    groupO.add_argument("-b", "--bytes", default="1M",
-                        help="maximum bytes per output file (default %(default)s); 0 means to put a single article per file",
-                        metavar="n[KMG]")
-    groupO.add_argument("-c", "--compress", action="store_true",
-                        help="compress output files using bzip")
+                        help="file for extracted text (or '-' for dumping to stdout)")
     groupO.add_argument("--json", action="store_true",
                         help="write output in json format instead of the default <doc> format")
 
@@ -551,11 +1271,41 @@ def process_wiki(dumpfile=None, outfile=None, htmlsafe=False, templates=False):
                         help="use or create file containing templates")
     groupP.add_argument("--no-templates", action="store_false",
                         help="Do not expand templates")
-    groupP.add_argument("--html-safe", default=True,
-                        help="use to produce HTML safe output within <doc>...</doc>")
+    groupP.add_argument("--template-store",
+                        help="use or create SQLite file storing the parsed templates of the dump snapshot")
+    groupP.add_argument("--template-cache-size", type=int, default=10000,
+                        help="Max number of parsed templates cached by each process (default %(default)s)")
+    groupP.add_argument("--expansion-cache-size", type=int, default=10000,
+                        help="Max number of template expansions memoized by each process (default %(default)s)")
+    groupP.add_argument("--snapshot",
+                        help="name of the dump snapshot, e.g. enwiki-20231101 (default from the dump file name, or its checksum list)")
+    groupP.add_argument("--no-html-safe", dest="html_safe", action="store_false",
+                        help="do not escape HTML reserved characters within <doc>...</doc>")
+    groupP.add_argument("--categories", metavar="NAMESPACE", nargs='?', const=True,
+                        help="report the categories of each article, given the localized name of the category namespace (by default, the one in the siteinfo of the dump)")
+    groupP.add_argument("--article-timeout", type=float, default=0,
+                        help="time budget in seconds for extracting an article, 0 for none (default %(default)s)")
+    groupP.add_argument("--timeout-fallback", choices=['drop', 'skip'], default='drop',
+                        help="on timeout, extract the article again with templates dropped, or skip it (default %(default)s)")
+    groupP.add_argument("--quarantine",
+                        help="file listing id, title and timing of articles exceeding the time budget")
     default_process_count = cpu_count() - 1
     parser.add_argument("--processes", type=int, default=default_process_count,
                         help="Number of processes to use (default %(default)s)")
+    parser.add_argument("--decompress-processes", type=int, default=0,
+                        help="Number of processes decompressing a multistream bz2 dump (default %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="Max number of articles dispatched to a process at once (default %(default)s)")
+    parser.add_argument("--batch-bytes", type=int, default=1024 * 1024,
+                        help="Max bytes of article text dispatched to a process at once (default %(default)s)")
+    parser.add_argument("--reorder-window", type=int, default=10000,
+                        help="Max number of articles extracted ahead of output (default %(default)s)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="write articles as soon as they are extracted, not in dump order")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split an uncompressed dump into this many byte ranges, extracted into output shards listed in OUTPUT.manifest (default %(default)s)")
+    parser.add_argument("--page-reader", choices=['regex', 'xml'], default='regex',
+                        help="read pages by scanning lines with regexes, or by parsing XML with expat (default %(default)s)")
 
     groupS = parser.add_argument_group('Special')
     groupS.add_argument("-q", "--quiet", action="store_true",
@@ -569,29 +1319,23 @@ def process_wiki(dumpfile=None, outfile=None, htmlsafe=False, templates=False):
                         help="print program version")
 
     args = parser.parse_args()
-    print(args)
-    print(args.output)
-
-    Extractor.keepLinks = args.links
-    Extractor.HtmlFormatting = args.html
-    if args.html:
-        Extractor.keepLinks = True
-    Extractor.to_json = args.json
-
-    expand_templates = args.no_templates
 
-    try:
-        power = 'kmg'.find(args.bytes[-1].lower()) + 1
-        # 0 bytes means put a single article per file.
-        file_size = 0 if args.bytes == '0' else int(args.bytes[:-1]) * 1024 ** power
-        if file_size and file_size < minFileSize:
-            raise ValueError()
-    except ValueError:
-        logging.error('Insufficient or invalid size: %s', args.bytes)
-        return
-
-    if args.namespaces:
-        acceptedNamespaces = set(args.namespaces.split(','))
+    options = ExtractOptions(keep_links=args.links, html=args.html, to_json=args.json,
+                             namespaces=args.namespaces.split(',') if args.namespaces else None,
+                             expand_templates=args.no_templates,
+                             template_file=args.templates, html_safe=args.html_safe,
+                             template_store=args.template_store, snapshot=args.snapshot,
+                             template_cache_size=args.template_cache_size,
+                             expansion_cache_size=args.expansion_cache_size,
+                             categories=args.categories,
+                             article_timeout=args.article_timeout,
+                             timeout_fallback=args.timeout_fallback,
+                             quarantine_file=args.quarantine,
+                             decompress_processes=args.decompress_processes,
+                             batch_size=args.batch_size, batch_bytes=args.batch_bytes,
+                             reorder_window=args.reorder_window,
+                             ordered=not args.unordered,
+                             page_reader=args.page_reader, shards=args.shards)
 
     FORMAT = '%(levelname)s: %(message)s'
     logging.basicConfig(format=FORMAT)
@@ -604,18 +1348,12 @@ def process_wiki(dumpfile=None, outfile=None, htmlsafe=False, templates=False):
 
     input_file = args.input
 
-    if not Extractor.keepLinks:
-        ignoreTag('a')
-
-    # sharing cache of parser templates is too slow:
-    # manager = Manager()
-    # templateCache = manager.dict()
-
     if args.article:
+        options.apply()
         if args.templates:
             if os.path.exists(args.templates):
                 with open(args.templates) as file:
-                    load_templates(file)
+                    load_templates(file, options=options)
 
         with open(input_file) as file:
             page = file.read()
@@ -637,16 +1375,7 @@ def process_wiki(dumpfile=None, outfile=None, htmlsafe=False, templates=False):
             Extractor(id, revid, urlbase, title, [page]).extract(sys.stdout)
         return
 
-    output_path = args.output
-    #if output_path != '-' and not os.path.isdir(output_path):
-    #    try:
-    #        os.makedirs(output_path)
-    #    except:
-    #        logging.error('Could not create: %s', output_path)
-    #        return
-
-    process_dump(input_file, args.templates, output_path, file_size,
-                 args.compress, args.processes, args.html_safe)
+    extract_dump(input_file, args.output, args.processes, options)
 
 
 if __name__ == '__main__':
@@ -21,10 +21,16 @@
 import re
 import html
 import json
+from collections import OrderedDict
 from itertools import zip_longest
 from urllib.parse import quote as urlencode
 from html.entities import name2codepoint
+import array
+import hashlib
 import logging
+import mmap
+import signal
+import threading
 import time
 
 # ----------------------------------------------------------------------
@@ -40,6 +46,11 @@ syntaxhighlight = re.compile('&lt;syntaxhighlight .*?&gt;(.*?)&lt;/syntaxhighlig
 # We include as default Template, when loading external template file.
 knownNamespaces = set(['Template'])
 
+##
+# The namespace used for template definitions, followed by ':'
+# It is the name associated with namespace key=10 in the siteinfo header.
+templatePrefix = 'Template:'
+
 ##
 # Drop these elements from article text
 #
@@ -57,7 +68,8 @@ discardElements = [
 # wiktionary: Wiki dictionary
 # wikt: shortcut for Wiktionary
 #
-acceptedNamespaces = ['w', 'wiktionary', 'wikt']
+defaultNamespaces = ['w', 'wiktionary', 'wikt']
+acceptedNamespaces = defaultNamespaces
 
 
 def get_url(urlbase, uid):
@@ -77,11 +89,16 @@ def clean(extractor, text, expand_templates=False, html_safe=True):
     :param html_safe: whether to convert reserved HTML characters to entities.
     @return: the cleaned text.
     """
+    global expansionTime
 
     if expand_templates:
         # expand templates
         # See: http://www.mediawiki.org/wiki/Help:Templates
-        text = extractor.expandTemplates(text)
+        start = time.time()
+        try:
+            text = extractor.expandTemplates(text)
+        finally:
+            expansionTime += time.time() - start
     else:
         # Drop transclusions (template, parser functions)
         text = dropNested(text, r'{{', r'}}')
@@ -92,8 +109,8 @@ def clean(extractor, text, expand_templates=False, html_safe=True):
     # replace external links
     text = replaceExternalLinks(text)
 
-    # replace internal links
-    text = replaceInternalLinks(text)
+    # replace internal links, collecting category links
+    text = replaceInternalLinks(text, extractor.category_links)
 
     # drop MagicWords behavioral switches
     text = magicWordsRE.sub('', text)
@@ -101,13 +118,14 @@ def clean(extractor, text, expand_templates=False, html_safe=True):
     # ############### Process HTML ###############
 
     # turn into HTML, except for the content of <syntaxhighlight>
-    res = ''
+    res = []
     cur = 0
     for m in syntaxhighlight.finditer(text):
-        end = m.end()
-        res += unescape(text[cur:m.start()]) + m.group(1)
-        cur = end
-    text = res + unescape(text[cur:])
+        res.append(unescape(text[cur:m.start()]))
+        res.append(m.group(1))
+        cur = m.end()
+    res.append(unescape(text[cur:]))
+    text = ''.join(res)
 
     # Handle bold/italic/quote
     if extractor.HtmlFormatting:
@@ -123,31 +141,22 @@ def clean(extractor, text, expand_templates=False, html_safe=True):
     # residuals of unbalanced quotes
     text = text.replace("'''", '').replace("''", '"')
 
-    # Collect spans
-
-    spans = []
-    # Drop HTML comments
-    for m in comment.finditer(text):
-        spans.append((m.start(), m.end()))
-
-    # Drop self-closing tags
-    for pattern in selfClosing_tag_patterns:
-        for m in pattern.finditer(text):
-            spans.append((m.start(), m.end()))
-
-    # Drop ignored tags
-    for left, right in ignored_tag_patterns:
-        for m in left.finditer(text):
-            spans.append((m.start(), m.end()))
-        for m in right.finditer(text):
-            spans.append((m.start(), m.end()))
+    # Collect spans of HTML comments, self-closing tags and ignored tags,
+    # in a single scan
+    spans = [m.span() for m in dropped_tags_pattern().finditer(text)]
 
     # Bulk remove all spans
     text = dropSpans(spans, text)
 
-    # Drop discarded elements
-    for tag in discardElements:
-        text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+    # Drop discarded elements, skipping those not occurring in text
+    found = discardedElements(text)
+    for tag, openDelim, closeDelim in discard_element_delims:
+        if tag in found:
+            dropped = dropNested(text, openDelim, closeDelim)
+            if len(dropped) != len(text):
+                # joining the text around a dropped element may form new tags
+                text = dropped
+                found = discardedElements(text)
 
     if not extractor.HtmlFormatting:
         # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
@@ -155,10 +164,7 @@ def clean(extractor, text, expand_templates=False, html_safe=True):
 
     # Expand placeholders
     for pattern, placeholder in placeholder_tag_patterns:
-        index = 1
-        for match in pattern.finditer(text):
-            text = text.replace(match.group(), '%s_%d' % (placeholder, index))
-            index += 1
+        text = pattern.sub(Placeholders(placeholder), text)
 
     text = text.replace('<<', u'«').replace('>>', u'»')
 
@@ -287,12 +293,19 @@ def compact(text, mark_headers=True):
 
 # ----------------------------------------------------------------------
 
+# Cache of compiled (open, close) delimiter patterns for dropNested()
+_nestedREs = {}
+
+
 def dropNested(text, openDelim, closeDelim):
     """
     A matching function for nested expressions, e.g. namespaces and tables.
     """
-    openRE = re.compile(openDelim, re.IGNORECASE)
-    closeRE = re.compile(closeDelim, re.IGNORECASE)
+    delims = (openDelim, closeDelim)
+    if delims not in _nestedREs:
+        _nestedREs[delims] = (re.compile(openDelim, re.IGNORECASE),
+                              re.compile(closeDelim, re.IGNORECASE))
+    openRE, closeRE = _nestedREs[delims]
     # partition text in separate blocks { } { }
     spans = []  # pairs (s, e) for each partition
     nest = 0  # nesting level
@@ -345,15 +358,15 @@ def dropSpans(spans, text):
     Drop from text the blocks identified in :param spans:, possibly nested.
     """
     spans.sort()
-    res = ''
+    res = []
     offset = 0
     for s, e in spans:
         if offset <= s:  # handle nesting
             if offset < s:
-                res += text[offset:s]
+                res.append(text[offset:s])
             offset = e
-    res += text[offset:]
-    return res
+    res.append(text[offset:])
+    return ''.join(res)
 
 
 # ----------------------------------------------------------------------
@@ -385,10 +398,10 @@ EXT_IMAGE_REGEX = re.compile(
 
 
 def replaceExternalLinks(text):
-    s = ''
+    s = []
     cur = 0
     for m in ExtLinkBracketedRegex.finditer(text):
-        s += text[cur:m.start()]
+        s.append(text[cur:m.start()])
         cur = m.end()
 
         url = m.group(1)
@@ -412,9 +425,10 @@ def replaceExternalLinks(text):
         # This means that users can paste URLs directly into the text
         # Funny characters like ö aren't valid in URLs anyway
         # This was changed in August 2004
-        s += makeExternalLink(url, label)  # + trail
+        s.append(makeExternalLink(url, label))  # + trail
 
-    return s + text[cur:]
+    s.append(text[cur:])
+    return ''.join(s)
 
 
 def makeExternalLink(url, anchor):
@@ -440,17 +454,19 @@ def makeExternalImage(url, alt=''):
 # Also: [[Help:IPA for Catalan|[andora]]]
 
 
-def replaceInternalLinks(text):
+def replaceInternalLinks(text, categories=None):
     """
     Replaces external links of the form:
     [[title |...|label]]trail
 
     with title concatenated with trail, when present, e.g. 's' for plural.
+    :param categories: list where to append the names of the categories
+        linked, if not None.
     """
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
     cur = 0
-    res = ''
+    res = []
     for s, e in findBalanced(text, ['[['], [']]']):
         m = tailRE.match(text, e)
         if m:
@@ -475,14 +491,19 @@ def replaceInternalLinks(text):
                     pipe = last  # advance
                 curp = e1
             label = inner[pipe + 1:].strip()
-        res += text[cur:s] + makeInternalLink(title, label) + trail
+        res.append(text[cur:s])
+        res.append(makeInternalLink(title, label, categories))
+        res.append(trail)
         cur = end
-    return res + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 
-def makeInternalLink(title, label):
+def makeInternalLink(title, label, categories=None):
     colon = title.find(':')
     if colon > 0 and title[:colon] not in acceptedNamespaces:
+        if categories is not None and title[:colon].strip().lower() in Extractor.categoryNamespaces:
+            categories.append(title[colon + 1:].strip())
         return ''
     if colon == 0:
         # drop also :File:
@@ -733,6 +754,23 @@ def unescape(text):
     return re.sub("&#?(\w+);", fixup, text)
 
 
+# Match discarded elements, with their content
+discard_element_delims = [
+    (tag, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag) for tag in discardElements
+]
+
+# Match the opening tag of any discarded element.
+# Only '<' and the name are consumed, since an opening tag may contain another.
+discardedElementRE = re.compile(r'<\s*(%s)\b(?=[^>/]*>)' % '|'.join(discardElements),
+                                re.IGNORECASE)
+
+
+def discardedElements(text):
+    """
+    :return: the set of discarded elements opened in :param text:.
+    """
+    return set(m.group(1).lower() for m in discardedElementRE.finditer(text))
+
 # Match HTML comments
 # The buggy template {{Template:T}} has a comment terminating with just "->"
 comment = re.compile(r'<!--.*?-->', re.DOTALL)
@@ -742,14 +780,40 @@ ignored_tag_patterns = []
 
 
 def ignoreTag(tag):
+    global droppedTagsRE
     left = re.compile(r'<%s\b.*?>' % tag, re.IGNORECASE | re.DOTALL)  # both <ref> and <reference>
     right = re.compile(r'</\s*%s>' % tag, re.IGNORECASE)
     ignored_tag_patterns.append((left, right))
+    droppedTagsRE = None
 
 
 def resetIgnoredTags():
-    global ignored_tag_patterns
+    global ignored_tag_patterns, droppedTagsRE
     ignored_tag_patterns = []
+    droppedTagsRE = None
+
+
+# Combined pattern of comments, self-closing and ignored tags, built on demand
+droppedTagsRE = None
+
+
+def dropped_tags_pattern():
+    """
+    :return: a regex matching HTML comments, self-closing tags and ignored
+    tags, as an alternation of those patterns.
+    All of them start with '<': factoring it out lets the search skip ahead
+    to the next '<'. Matches can only nest, never overlap partially, so the
+    spans of the alternation, once nested ones are dropped, are those of the
+    separate patterns.
+    """
+    global droppedTagsRE
+    if not droppedTagsRE:
+        patterns = [comment] + selfClosing_tag_patterns
+        for left, right in ignored_tag_patterns:
+            patterns.extend((left, right))
+        droppedTagsRE = re.compile('<(?:%s)' % '|'.join(p.pattern[1:] for p in patterns),
+                                   re.IGNORECASE | re.DOTALL)
+    return droppedTagsRE
 
 
 for tag in ignoredTags:
@@ -766,6 +830,24 @@ placeholder_tag_patterns = [
      repl) for tag, repl in placeholder_tags.items()
 ]
 
+
+class Placeholders():
+
+    """
+    Replacement function numbering the matches of a placeholder tag.
+    Repeated occurrences of a match share its number.
+    """
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.index = 0
+        self.seen = {}
+
+    def __call__(self, match):
+        self.index += 1
+        return self.seen.setdefault(match.group(), '%s_%d' % (self.placeholder, self.index))
+
+
 # Match preformatted lines
 preformatted = re.compile(r'^ .*?$')
 
@@ -791,6 +873,113 @@ dots = re.compile(r'\.{4,}')
 substWords = 'subst:|safesubst:'
 
 
+class ExtractionTimeout(Exception):
+    """
+    Raised when the extraction of an article exceeds Extractor.timeout.
+    """
+    pass
+
+
+##
+# Whether the article being cleaned exceeded its time budget. While set,
+# expansions and template definitions are not cached, since the exception
+# may have been swallowed by one of the catch-all handlers (e.g. in
+# callParserFunction) and left them truncated.
+timedOut = False
+
+##
+# Whether the timer of clean_with_budget() is armed.
+timerArmed = False
+
+
+def _timeout_handler(signum, frame):
+    global timedOut
+    if not timerArmed:
+        # delivered while the timer was being disarmed
+        return
+    timedOut = True
+    raise ExtractionTimeout()
+
+
+class Document():
+
+    """
+    An extracted article.
+    """
+
+    def __init__(self, id, revid, url, title, text, categories=None):
+        """
+        :param text: the list of lines of the article, with section headers
+            marked as "## Header".
+        :param categories: the list of categories of the article, None if they
+            were not collected.
+        """
+        self.id = id
+        self.revid = revid
+        self.url = url
+        self.title = title
+        self.text = text
+        self.categories = categories
+
+    @property
+    def paragraphs(self):
+        """
+        The lines of the article, without section headers.
+        """
+        return [line for line in self.text if not line.startswith('## ')]
+
+    @property
+    def sections(self):
+        """
+        The list of (header, paragraphs) of the article, where the header of the
+        leading section is ''.
+        """
+        sections = [('', [])]
+        for line in self.text:
+            if line.startswith('## '):
+                sections.append((line[3:], []))
+            else:
+                sections[-1][1].append(line)
+        if not sections[0][1]:
+            sections.pop(0)
+        return sections
+
+    def header(self):
+        """
+        :return: the opening <doc> tag of the article.
+        """
+        if self.categories is not None:
+            return '<doc id="%s" url="%s" title="%s" categories="%s">\n' % (
+                self.id, self.url, self.title, '|'.join(self.categories))
+        return '<doc id="%s" url="%s" title="%s">\n' % (self.id, self.url, self.title)
+
+    def write(self, out, to_json=False):
+        """
+        Write the article to :param out:, in json or <doc> format.
+        """
+        if to_json:
+            json_data = {
+                'id': self.id,
+                'revid': self.revid,
+                'url': self.url,
+                'title': self.title,
+                'text': "\n".join(self.text)
+            }
+            if self.categories is not None:
+                json_data['categories'] = self.categories
+            out_str = json.dumps(json_data)
+            out.write(out_str)
+            out.write('\n')
+        else:
+            # Separate header from text with a newline.
+            header = self.header() + self.title + '\n\n'
+            footer = "\n</doc>\n"
+            out.write(header)
+            out.write('\n'.join(self.text))
+            out.write('\n')
+            out.write(footer)
+
+
 class Extractor():
     """
     An extraction task on a article.
@@ -809,7 +998,28 @@ class Extractor():
 
     ##
     # Whether to produce json instead of the default <doc> output format.
-    toJson = False
+    to_json = False
+
+    ##
+    # Lowercased names of the category namespace, e.g. 'category'.
+    # If set, the categories of each article are added to its header.
+    categoryNamespaces = set()
+
+    ##
+    # Whether to expand templates, rather than dropping them.
+    expand_templates = False
+
+    ##
+    # Time budget in seconds for extracting an article, 0 for no limit.
+    # Only enforced in the main thread of a process.
+    timeout = 0
+
+    ##
+    # What to do with articles exceeding the time budget:
+    # 'drop': extract them again with templates dropped instead of expanded,
+    #   skipping them if that times out as well;
+    # 'skip': leave them out of the output.
+    timeoutFallback = 'drop'
 
     def __init__(self, id, revid, urlbase, title, page):
         """
@@ -826,6 +1036,11 @@ class Extractor():
         self.recursion_exceeded_2_errs = 0  # template recursion within expandTemplate()
         self.recursion_exceeded_3_errs = 0  # parameter recursion
         self.template_title_errs = 0
+        self.frameDependent = False  # whether the current expansion depends on article or frame
+        self.timed_out = False  # whether the time budget was exceeded
+        self.elapsed = 0.0  # extraction time
+        self.skipped = False  # whether the article was left out
+        self.category_links = None  # categories linked, when they are collected
 
     def clean_text(self, text, mark_headers=True, expand_templates=False,
                    html_safe=True):
@@ -852,38 +1067,79 @@ class Extractor():
         :param out: a memory file.
         :param html_safe: whether to escape HTML entities.
         """
+        document = self.document(html_safe)
+        if document:
+            document.write(out, self.to_json)
+
+    def document(self, html_safe=True):
+        """
+        :param html_safe: whether to escape HTML entities.
+        :return: the extracted Document, or None if the article was skipped.
+        """
         logging.debug("%s\t%s", self.id, self.title)
+        start = time.time()
         text = ''.join(self.page)
-        text = self.clean_text(text, html_safe=html_safe)
-
-        if self.to_json:
-            json_data = {
-		'id': self.id,
-                'revid': self.revid,
-                'url': self.url,
-                'title': self.title,
-                'text': "\n".join(text)
-            }
-            out_str = json.dumps(json_data)
-            out.write(out_str)
-            out.write('\n')
-        else:
-            header = '<doc id="%s" url="%s" title="%s">\n' % (self.id, self.url, self.title)
-            # Separate header from text with a newline.
-            header += self.title + '\n\n'
-            footer = "\n</doc>\n"
-            out.write(header)
-            out.write('\n'.join(text))
-            out.write('\n')
-            out.write(footer)
+        self.category_links = [] if self.categoryNamespaces else None
+        try:
+            text = self.clean_with_budget(text, self.expand_templates, html_safe)
+        except ExtractionTimeout:
+            self.timed_out = True
+            text = None
+            if self.timeoutFallback == 'drop' and self.expand_templates:
+                if self.category_links is not None:
+                    self.category_links = []  # collected again
+                try:
+                    text = self.clean_with_budget(''.join(self.page), False, html_safe)
+                except ExtractionTimeout:
+                    pass
+        self.elapsed = time.time() - start
+        if text is None:
+            self.skipped = True
+            logging.warning("Skipped article '%s' (%s) after %.1fs", self.title, self.id, self.elapsed)
+            return None
+        if self.timed_out:
+            logging.warning("Dropped templates from article '%s' (%s) after %.1fs",
+                            self.title, self.id, self.elapsed)
+
+        errs = self.template_errors()
+        if any(errs):
+            logging.warn("Template errors in article '%s' (%s): title(%d) recursion(%d, %d, %d)",
+                         self.title, self.id, *errs)
+        return Document(self.id, self.revid, self.url, self.title, text, self.category_links)
 
-        errs = (self.template_title_errs,
+    def template_errors(self):
+        """
+        :return: the counts of template errors: title, recursion (3 kinds).
+        """
+        return (self.template_title_errs,
                 self.recursion_exceeded_1_errs,
                 self.recursion_exceeded_2_errs,
                 self.recursion_exceeded_3_errs)
-        if any(errs):
-            logging.warn("Template errors in article '%s' (%s): title(%d) recursion(%d, %d, %d)",
-                         self.title, self.id, *errs)
+
+    def clean_with_budget(self, text, expand_templates, html_safe):
+        """
+        Run clean_text() on :param text:, raising ExtractionTimeout after
+        self.timeout seconds.
+        """
+        if (not self.timeout or not hasattr(signal, 'setitimer') or
+                threading.current_thread() is not threading.main_thread()):
+            return self.clean_text(text, expand_templates=expand_templates,
+                                   html_safe=html_safe)
+        global timedOut, timerArmed
+        timedOut = False
+        previous = signal.signal(signal.SIGALRM, _timeout_handler)
+        timerArmed = True
+        # fire again every 10ms, in case the exception is swallowed by one of
+        # the catch-all handlers
+        signal.setitimer(signal.ITIMER_REAL, self.timeout, 0.01)
+        try:
+            return self.clean_text(text, expand_templates=expand_templates,
+                                   html_safe=html_safe)
+        finally:
+            timerArmed = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            timedOut = False
 
     # ----------------------------------------------------------------------
     # Expand templates
@@ -916,22 +1172,23 @@ class Extractor():
         # Test template expansion at:
         # https://en.wikipedia.org/wiki/Special:ExpandTemplates
 
-        res = ''
         if len(self.frame) >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_1_errs += 1
-            return res
+            return ''
 
         # logging.debug('<expandTemplates ' + str(len(self.frame)))
 
+        res = []
         cur = 0
         # look for matching {{...}}
         for s, e in findMatchingBraces(wikitext, 2):
-            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
+            res.append(wikitext[cur:s])
+            res.append(self.expandTemplate(wikitext[s + 2:e - 2]))
             cur = e
         # leftover
-        res += wikitext[cur:]
+        res.append(wikitext[cur:])
         # logging.debug('   expandTemplates> %d %s', len(self.frame), res)
-        return res
+        return ''.join(res)
 
     def templateParams(self, parameters):
         """
@@ -1069,6 +1326,7 @@ class Extractor():
             subst = True
 
         if title.lower() in self.magicWords.values:
+            self.frameDependent = True
             return self.magicWords[title.lower()]
 
         # Parser functions
@@ -1078,6 +1336,8 @@ class Extractor():
         if colon > 1:
             funct = title[:colon]
             parts[0] = title[colon + 1:].strip()  # side-effect (parts[0] not used later)
+            if funct == '#invoke':
+                self.frameDependent = True
             # arguments after first are not evaluated
             ret = callParserFunction(funct, parts, self.frame)
             return self.expandTemplates(ret)
@@ -1087,19 +1347,13 @@ class Extractor():
             self.template_title_errs += 1
             return ''
 
-        redirected = redirects.get(title)
+        redirected = get_redirect(title)
         if redirected:
             title = redirected
 
         # get the template
-        if title in templateCache:
-            template = templateCache[title]
-        elif title in templates:
-            template = Template.parse(templates[title])
-            # add it to cache
-            templateCache[title] = template
-            del templates[title]
-        else:
+        template = get_template(title)
+        if template is None:
             # The page being included could not be identified
             return ''
 
@@ -1144,6 +1398,18 @@ class Extractor():
         # build a dict of name-values for the parameter values
         params = self.templateParams(params)
 
+        # Expansions depending neither on the article (magic words) nor on
+        # the frame (#invoke) are memoized
+        key = None
+        if not subst:
+            key = (title, tuple(sorted(params.items())))
+            value = expansionCache.get(key)
+            if value is not None:
+                return value
+        dependent = self.frameDependent
+        self.frameDependent = False
+        errs = self.template_errors()
+
         # Perform parameter substitution
         # extend frame before subst, since there may be recursion in default
         # parameter value, e.g. {{OTRS|celebrative|date=April 2015}} in article
@@ -1154,6 +1420,11 @@ class Extractor():
         value = self.expandTemplates(instantiated)
         self.frame.pop()
         # logging.debug('   INVOCATION> %s %d %s', title, len(self.frame), value)
+        # results cut short by recursion limits depend on the frame depth
+        if key and not self.frameDependent and self.template_errors() == errs \
+           and not timedOut:
+            expansionCache[key] = value
+        self.frameDependent = self.frameDependent or dependent
         return value
 
 
@@ -1233,6 +1504,12 @@ def splitParts(paramsList):
     return parameters
 
 
+bracesOpenRE = {n: re.compile('[{]{%d,}' % n) for n in (2, 3)}
+bracesNextRE = re.compile('[{]{2,}|}{2,}')
+bracketsOpenRE = re.compile('{{2,}|\[{2,}')
+bracketsNextRE = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')
+
+
 def findMatchingBraces(text, ldelim=0):
     """
     :param ldelim: number of braces to match. 0 means match [[]], {{}} and {{{}}}.
@@ -1272,11 +1549,11 @@ def findMatchingBraces(text, ldelim=0):
     #   {{{link|{{ucfirst:{{{1}}}}}} interchange}}}
 
     if ldelim:  # 2-3
-        reOpen = re.compile('[{]{%d,}' % ldelim)  # at least ldelim
-        reNext = re.compile('[{]{2,}|}{2,}')  # at least 2
+        reOpen = bracesOpenRE[ldelim]  # at least ldelim
+        reNext = bracesNextRE  # at least 2
     else:
-        reOpen = re.compile('{{2,}|\[{2,}')
-        reNext = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')  # at least 2
+        reOpen = bracketsOpenRE
+        reNext = bracketsNextRE  # at least 2
 
     cur = 0
     while True:
@@ -1342,6 +1619,10 @@ def findMatchingBraces(text, ldelim=0):
                 cur = end
 
 
+# Cache of compiled (start, after) patterns for findBalanced()
+_balancedREs = {}
+
+
 def findBalanced(text, openDelim, closeDelim):
     """
     Assuming that text contains a properly balanced expression using
@@ -1350,15 +1631,18 @@ def findBalanced(text, openDelim, closeDelim):
     :return: an iterator producing pairs (start, end) of start and end
     positions in text containing a balanced expression.
     """
-    openPat = '|'.join([re.escape(x) for x in openDelim])
-    # patter for delimiters expected after each opening delimiter
-    afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
+    delims = (tuple(openDelim), tuple(closeDelim))
+    if delims not in _balancedREs:
+        openPat = '|'.join([re.escape(x) for x in openDelim])
+        # patter for delimiters expected after each opening delimiter
+        afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
+        _balancedREs[delims] = (re.compile(openPat), afterPat)
+    startPat, afterPat = _balancedREs[delims]
     stack = []
     start = 0
     cur = 0
     # end = len(text)
     startSet = False
-    startPat = re.compile(openPat)
     nextPat = startPat
     while True:
         next = nextPat.search(text, cur)
@@ -1579,6 +1863,19 @@ def sharp_switch(primary, *params):
     return ''
 
 
+# ----------------------------------------------------------------------
+# Modules
+
+# Only minimal support
+# FIXME: import Lua modules.
+
+modules = {
+    'convert': {
+        'convert': lambda x, u, *rest: x + ' ' + u,  # no conversion
+    }
+}
+
+
 # Extension Scribuntu
 def sharp_invoke(module, function, frame):
     functions = modules.get(module)
@@ -1669,28 +1966,335 @@ def callParserFunction(functionName, args, frame):
     return ""
 
 
+# ----------------------------------------------------------------------
+# Template
+
+
+class Template(list):
+    """
+    A Template is a list of TemplateText or TemplateArgs
+    """
+
+    @classmethod
+    def parse(cls, body):
+        tpl = Template()
+        # we must handle nesting, s.a.
+        # {{{1|{{PAGENAME}}}
+        # {{{italics|{{{italic|}}}
+        # {{#if:{{{{{#if:{{{nominee|}}}|nominee|candidate}}|}}}|
+        #
+        start = 0
+        for s, e in findMatchingBraces(body, 3):
+            tpl.append(TemplateText(body[start:s]))
+            tpl.append(TemplateArg(body[s + 3:e - 3]))
+            start = e
+        tpl.append(TemplateText(body[start:]))  # leftover
+        return tpl
+
+    def subst(self, params, extractor, depth=0):
+        # We perform parameter substitutions recursively.
+        # We also limit the maximum number of iterations to avoid too long or
+        # even endless loops (in case of malformed input).
+
+        # :see: http://meta.wikimedia.org/wiki/Help:Expansion#Distinction_between_variables.2C_parser_functions.2C_and_templates
+        #
+        # Parameter values are assigned to parameters in two (?) passes.
+        # Therefore a parameter name in a template can depend on the value of
+        # another parameter of the same template, regardless of the order in
+        # which they are specified in the template call, for example, using
+        # Template:ppp containing "{{{{{{p}}}}}}", {{ppp|p=q|q=r}} and even
+        # {{ppp|q=r|p=q}} gives r, but using Template:tvvv containing
+        # "{{{{{{{{{p}}}}}}}}}", {{tvvv|p=q|q=r|r=s}} gives s.
+
+        # logging.debug('subst tpl (%d, %d) %s', len(extractor.frame), depth, self)
+
+        if depth > extractor.maxParameterRecursionLevels:
+            extractor.recursion_exceeded_3_errs += 1
+            return ''
+
+        return ''.join([tpl.subst(params, extractor, depth) for tpl in self])
+
+    def __str__(self):
+        return ''.join([str(x) for x in self])
+
+
+class TemplateText(str):
+    """Fixed text of template"""
+
+    def subst(self, params, extractor, depth):
+        return self
+
+
+class TemplateArg():
+    """
+    parameter to a template.
+    Has a name and a default value, both of which are Templates.
+    """
+
+    def __init__(self, parameter):
+        """
+        :param parameter: the parts of a tplarg.
+        """
+        # the parameter name itself might contain templates, e.g.:
+        #   appointe{{#if:{{{appointer14|}}}|r|d}}14|
+        #   4|{{{{{subst|}}}CURRENTYEAR}}
+
+        # any parts in a tplarg after the first (the parameter default) are
+        # ignored, and an equals sign in the first part is treated as plain text.
+        # logging.debug('TemplateArg %s', parameter)
+
+        parts = splitParts(parameter)
+        self.name = Template.parse(parts[0])
+        if len(parts) > 1:
+            # This parameter has a default value
+            self.default = Template.parse(parts[1])
+        else:
+            self.default = None
+
+    def __str__(self):
+        if self.default:
+            return '{{{%s|%s}}}' % (self.name, self.default)
+        else:
+            return '{{{%s}}}' % self.name
+
+    def subst(self, params, extractor, depth):
+        """
+        Substitute value for this argument from dict :param params:
+        Use :param extractor: to evaluate expressions for name and default.
+        Limit substitution to the maximun :param depth:.
+        """
+        # the parameter name itself might contain templates, e.g.:
+        # appointe{{#if:{{{appointer14|}}}|r|d}}14|
+        paramName = self.name.subst(params, extractor, depth + 1)
+        paramName = extractor.expandTemplates(paramName)
+        res = ''
+        if paramName in params:
+            res = params[paramName]  # use parameter value specified in template invocation
+        elif self.default:  # use the default value
+            defaultValue = self.default.subst(params, extractor, depth + 1)
+            res = extractor.expandTemplates(defaultValue)
+        # logging.debug('subst arg %d %s -> %s' % (depth, paramName, res))
+        return res
+
+
 # ----------------------------------------------------------------------
 # Extract Template definition
 
 reNoinclude = re.compile(r'<noinclude>(?:.*?)</noinclude>', re.DOTALL)
 reIncludeonly = re.compile(r'<includeonly>|</includeonly>', re.DOTALL)
 
+class LRUCache():
+
+    """
+    Mapping holding at most maxsize items, evicting the least recently used.
+    Lookups and evictions are counted.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.items)}
+
+
 # These are built before spawning processes, hence thay are shared.
 templates = {}
 redirects = {}
-# cache of parser templates
+# cache of parser templates, None for undefined ones
 # FIXME: sharing this with a Manager slows down.
-templateCache = {}
+templateCache = LRUCache()
+# cache of template expansions, by (title, params)
+expansionCache = LRUCache()
+# time spent expanding templates, in seconds
+expansionTime = 0.0
+
+# marks templates missing from templateCache
+_missing = object()
+
+##
+# Persistent TemplateStore, looked up for templates not in templates
+templateStore = None
 
+class TemplateIndex():
 
-def define_template(title, page):
+    """
+    Read-only index of the template texts saved in a file, by title.
+    The file is mapped in memory and the index is an open addressing hash
+    table held in arrays, keyed by a 64 bit hash of the titles. The table is
+    thus a few objects, whose pages stay shared by forked processes, instead
+    of a dict with objects for each template, which reference counting and
+    garbage collection copy into every process.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.keys = array.array('q')
+        self.titles = array.array('q')  # offset and length, alternating
+        self.texts = array.array('q')  # offset and length, alternating
+        self.slots = array.array('q')  # 1 + entry, 0 for empty slots
+        self.map = None
+
+    @staticmethod
+    def key(title):
+        return int.from_bytes(hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(),
+                              'little', signed=True)
+
+    def add(self, title, title_offset, title_length, text_offset, text_length):
+        """
+        Index template :param title:, given the byte spans of its title and
+        text in the file.
+        """
+        self.keys.append(self.key(title))
+        self.titles.extend((title_offset, title_length))
+        self.texts.extend((text_offset, text_length))
+
+    def freeze(self):
+        """
+        Build the hash table and map the file, once all templates are added.
+        """
+        size = 2
+        while size < 2 * len(self.keys):
+            size *= 2
+        mask = size - 1
+        self.slots = array.array('q', bytes(8 * size))
+        for entry, key in enumerate(self.keys):
+            slot = key & mask
+            while self.slots[slot]:
+                slot = (slot + 1) & mask
+            self.slots[slot] = entry + 1
+        if self.keys:
+            with open(self.filename, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def text(self, title):
+        """
+        :return: the raw text of template :param title:, None if not indexed.
+        """
+        if not self.map:
+            return None
+        key = self.key(title)
+        mask = len(self.slots) - 1
+        slot = key & mask
+        while self.slots[slot]:
+            entry = self.slots[slot] - 1
+            if self.keys[entry] == key:
+                offset, length = self.titles[2 * entry], self.titles[2 * entry + 1]
+                if self.map[offset:offset + length] == title.encode('utf-8'):
+                    offset, length = self.texts[2 * entry], self.texts[2 * entry + 1]
+                    return self.map[offset:offset + length].decode('utf-8')
+            slot = (slot + 1) & mask
+        return None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+
+
+##
+# TemplateIndex of the templates not defined yet, which are defined when
+# first requested
+templateIndex = None
+
+
+def load_template(title):
+    """
+    Define the template :param title: from templateIndex, if it is indexed
+    there and not defined yet.
+    """
+    if templateIndex is None or title in templates or title in redirects or timedOut:
+        return
+    text = templateIndex.text(title)
+    if text is not None:
+        define_template(title, [text])
+
+
+def get_template(title):
+    """
+    :return: the parsed template called :param title:, None if not defined.
+    """
+    template = templateCache.get(title, _missing)
+    if template is not _missing:
+        return template
+    load_template(title)
+    if title in templates:
+        template = Template.parse(templates[title])
+    elif templateStore:
+        template = templateStore.template(title)
+    else:
+        template = None
+    # add it to cache
+    if not timedOut:
+        templateCache[title] = template
+    return template
+
+
+def set_template_caches(templates_size, expansions_size):
+    """
+    Replace the caches of parsed templates and of template expansions with
+    empty ones holding at most the given number of items.
+    """
+    global templateCache, expansionCache
+    templateCache = LRUCache(templates_size)
+    expansionCache = LRUCache(expansions_size)
+
+
+def template_stats():
+    """
+    :return: the counters of the template caches of this process, and the
+    time spent expanding templates.
+    """
+    return {'templates': templateCache.stats(),
+            'expansions': expansionCache.stats(),
+            'seconds': expansionTime}
+
+
+def get_redirect(title):
+    """
+    :return: the title of the template :param title: redirects to, if any.
+    """
+    load_template(title)
+    redirected = redirects.get(title)
+    if redirected is None and templateStore:
+        redirected = templateStore.redirect(title)
+    return redirected
+
+
+def define_template(title, page, templates=templates, redirects=redirects):
     """
     Adds a template defined in the :param page:.
+    :param templates: dict where to define it, by default the module one.
+    :param redirects: dict where to record it if it is a redirect.
     @see https://en.wikipedia.org/wiki/Help:Template#Noinclude.2C_includeonly.2C_and_onlyinclude
     """
-    global templates
-    global redirects
-
     # title = normalizeTitle(title)
 
     # check for redirects
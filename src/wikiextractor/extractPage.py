@@ -31,6 +31,10 @@ import sys, os.path
 import re
 import argparse
 import bz2
+import html
+from collections import defaultdict
+
+from .multistream import index_filename, read_index, stream_spans, decompress_stream
 
 
 # Program version
@@ -96,23 +100,177 @@ def process_data(input_file, id, templates=False):
 
     input.close()
 
+# ----------------------------------------------------------------------
+# Indexed lookup
+
+pageRE = re.compile(r'<page>.*?</page>', re.DOTALL)
+idRE = re.compile(r'<id>(\d*?)</id>')
+titleRE = re.compile(r'<title>(.*?)</title>')
+
+
+def page_key(page):
+    """
+    :return: the (id, title) of the XML :param page:, title unescaped as in
+    multistream index files.
+    """
+    m = idRE.search(page)
+    id = m.group(1) if m else ''
+    m = titleRE.search(page)
+    title = html.unescape(m.group(1)) if m else ''
+    return id, title
+
+
+def offsets_filename(input_file):
+    """
+    :return: the name of the offset index for :param input_file:: the
+    companion index of a multistream dump, or a file next to the dump.
+    """
+    return index_filename(input_file) or input_file + '.index.txt.bz2'
+
+
+def multistream_spans(input_file):
+    """
+    :return: the stream spans of bz2 file :param input_file:.
+    :raise ValueError: if it is a single bz2 stream, in which pages cannot be
+        reached without decompressing everything before them.
+    """
+    spans = stream_spans(input_file)
+    if len(spans) < 2:
+        raise ValueError("%s is not a multistream bz2 dump: indexed lookup needs a "
+                         "pages-articles-multistream dump, or the decompressed XML file." % input_file)
+    return spans
+
+
+def build_index(input_file, index_file):
+    """
+    Scan :param input_file: once and save an index in the multistream index
+    format, offset:id:title, to :param index_file:.
+    For bz2 files offsets are those of the stream holding each page, for XML
+    files those of the <page> line.
+    """
+    if input_file.lower().endswith(".bz2"):
+        spans = multistream_spans(input_file)
+    with bz2.open(index_file, 'wt', encoding='utf-8') as index:
+        if input_file.lower().endswith(".bz2"):
+            for start, end in spans:
+                text = decompress_stream(input_file, start, end).decode('utf-8')
+                for m in pageRE.finditer(text):
+                    index.write('%d:%s:%s\n' % ((start,) + page_key(m.group())))
+        else:
+            with open(input_file, 'rb') as input:
+                offset = 0
+                for line in input:
+                    if b'<page>' in line:
+                        start = offset
+                        page = []
+                    if b'<title>' in line or b'<id>' in line:
+                        page.append(line.decode('utf-8'))
+                    if b'</page>' in line:
+                        index.write('%d:%s:%s\n' % ((start,) + page_key(''.join(page))))
+                    offset += len(line)
+
+
+def load_index(input_file, index_file=None):
+    """
+    Load the offset index of :param input_file:, building it on first use.
+    :return: a pair of dicts (id -> offset, title -> offset).
+    """
+    if index_file is None:
+        index_file = offsets_filename(input_file)
+    if not os.path.exists(index_file):
+        build_index(input_file, index_file)
+    byId = {}
+    byTitle = {}
+    for offset, id, title in read_index(index_file):
+        byId[id] = offset
+        byTitle[title] = offset
+    return byId, byTitle
+
+
+# end offset of each stream, by file
+streamEnds = {}
+
+
+def read_pages(input_file, offset):
+    """
+    :return: the XML pages stored at :param offset: of :param input_file:.
+    A whole stream for bz2 files, a single page for XML files.
+    """
+    if input_file.lower().endswith(".bz2"):
+        if input_file not in streamEnds:
+            streamEnds[input_file] = dict(multistream_spans(input_file))
+        end = streamEnds[input_file][offset]
+        text = decompress_stream(input_file, offset, end).decode('utf-8')
+        return pageRE.findall(text)
+    with open(input_file, 'rb') as input:
+        input.seek(offset)
+        page = []
+        for line in input:
+            page.append(line)
+            if b'</page>' in line:
+                break
+        return [b''.join(page).decode('utf-8')]
+
+
+def extract_pages(input_file, ids=(), titles=(), index_file=None):
+    """
+    Random access lookup of pages through an offset index.
+    Requested pages are grouped by offset, so that each bz2 stream is
+    decompressed only once.
+    :param ids: ids of the pages to extract.
+    :param titles: titles of the pages to extract.
+    :return: an iterator over the XML text of the pages found, in file order.
+    """
+    byId, byTitle = load_index(input_file, index_file)
+    wanted = defaultdict(set)
+    for id in ids:
+        if id in byId:
+            wanted[byId[id]].add(id)
+    for title in titles:
+        if title in byTitle:
+            wanted[byTitle[title]].add(title)
+    for offset in sorted(wanted):
+        keys = wanted[offset]
+        for page in read_pages(input_file, offset):
+            id, title = page_key(page)
+            if id in keys or title in keys:
+                yield page
+
+
 def main():
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
         formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=__doc__)
     parser.add_argument("input",
                         help="XML wiki dump file")
-    parser.add_argument("--id", default="1",
-                        help="article number")
+    parser.add_argument("--id",
+                        help="article number, or comma separated list of article numbers")
+    parser.add_argument("--title", action="append", default=[],
+                        help="article title (with --index; can be repeated)")
+    parser.add_argument("--ids-file",
+                        help="file with one article number per line (with --index)")
     parser.add_argument("--template", action="store_true",
                         help="template number")
+    parser.add_argument("--index", action="store_true",
+                        help="look pages up through the multistream index, building an offset index if missing")
     parser.add_argument("-v", "--version", action="version",
-                        version='%(prog)s ' + version,
+                        version='%(prog)s ' + __version__,
                         help="print program version")
 
     args = parser.parse_args()
 
-    process_data(args.input, args.id, args.template)
+    if args.index:
+        ids = args.id.split(',') if args.id else []
+        if args.ids_file:
+            with open(args.ids_file) as f:
+                ids.extend(line.strip() for line in f if line.strip())
+        try:
+            for page in extract_pages(args.input, ids, args.title):
+                print(page)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        process_data(args.input, args.id or "1", args.template)
 
 if __name__ == '__main__':
     main()
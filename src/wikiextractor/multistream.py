@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+#  This file is part of Tanl.
+#
+#  Tanl is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License, version 3,
+#  as published by the Free Software Foundation.
+#
+#  Tanl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# =============================================================================
+
+"""Multistream bz2 support:
+Wikimedia's pages-articles-multistream dumps are concatenations of independent
+bz2 streams, each holding up to 100 pages. The companion index file lists,
+for each page, the offset of the stream containing it:
+
+    offset:id:title
+
+Streams can therefore be decompressed independently, in parallel, or
+individually for random access.
+"""
+
+import bz2
+import codecs
+import logging
+import os.path
+import re
+from collections import deque
+
+from .pools import safe_pool_context
+
+# A bz2 stream starts with 'BZh', the block size digit and the block magic
+# 0x314159265359 (pi).
+streamHeaderRE = re.compile(rb'BZh[1-9]1AY&SY')
+
+
+def index_filename(filename):
+    """
+    :return: the name of the companion index of multistream dump :param filename:
+    e.g. enwiki-latest-pages-articles-multistream1.xml-p1p41242.bz2 ->
+    enwiki-latest-pages-articles-multistream-index1.txt-p1p41242.bz2
+    """
+    dirname, basename = os.path.split(filename)
+    if 'multistream' not in basename:
+        return None
+    basename = basename.replace('multistream', 'multistream-index', 1).replace('.xml', '.txt', 1)
+    return os.path.join(dirname, basename)
+
+
+def read_index(index_file):
+    """
+    Iterate over the entries of a multistream index file.
+    :return: an iterator over (offset, id, title) tuples.
+    """
+    opener = bz2.open if index_file.endswith('.bz2') else open
+    with opener(index_file, 'rt', encoding='utf-8') as f:
+        for line in f:
+            # titles may contain ':'
+            offset, id, title = line.rstrip('\n').split(':', 2)
+            yield int(offset), id, title
+
+
+def scan_stream_offsets(filename, chunk_size=16 * 1024 * 1024):
+    """
+    Find the stream boundaries of :param filename: by scanning for stream
+    headers, for dumps without an index.
+    :return: the sorted list of stream start offsets.
+    """
+    offsets = []
+    overlap = 9  # header length - 1
+    with open(filename, 'rb') as f:
+        base = 0
+        tail = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = tail + chunk
+            start = base - len(tail)
+            for m in streamHeaderRE.finditer(data):
+                offsets.append(start + m.start())
+            tail = data[-overlap:]
+            base += len(chunk)
+    return offsets
+
+
+def stream_offsets(filename, index_file=None):
+    """
+    :param index_file: the companion index file. If None, it is looked up next
+        to :param filename:, and the file is scanned when it does not exist.
+    :return: the sorted list of stream start offsets of :param filename:.
+    """
+    if index_file is None:
+        index_file = index_filename(filename)
+    if index_file and os.path.exists(index_file):
+        # the first stream holds the <siteinfo> header and is not indexed
+        offsets = set([0])
+        for offset, _, _ in read_index(index_file):
+            offsets.add(offset)
+        return sorted(offsets)
+    return scan_stream_offsets(filename)
+
+
+def stream_spans(filename, index_file=None):
+    """
+    :return: the list of (start, end) byte spans of the streams in :param filename:.
+    """
+    offsets = stream_offsets(filename, index_file)
+    size = os.path.getsize(filename)
+    return list(zip(offsets, offsets[1:] + [size]))
+
+
+def decompress_stream(filename, start, end):
+    """
+    Decompress the bytes of :param filename: between :param start: and :param end:.
+    The span may contain several consecutive streams.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b''.join(out)
+
+
+def _decompress_job(job):
+    return decompress_stream(*job)
+
+
+class MultistreamReader():
+
+    """
+    Line iterator over a multistream bz2 file, decompressing streams in a pool
+    of processes while yielding lines in order.
+    Usable wherever the text file returned by decode_open() is.
+    The pool is alive while the extraction workers are forked and the
+    mapper thread runs, so it is started from safe_pool_context(): the main
+    module of the program must be guarded by if __name__ == '__main__'.
+    """
+
+    def __init__(self, filename, processes=2, index_file=None, encoding='utf-8'):
+        """
+        :param processes: number of decompression processes.
+        :param index_file: companion index file, looked up if None.
+        """
+        self.filename = filename
+        self.processes = max(1, processes)
+        self.spans = stream_spans(filename, index_file)
+        self.encoding = encoding
+        self.pool = None
+        self.lines = self._lines()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def _texts(self):
+        if len(self.spans) < 2:
+            # a single stream: no parallelism possible, and no point in
+            # decompressing it all in memory
+            logging.info("%s is not a multistream file, decompressing sequentially.", self.filename)
+            with bz2.open(self.filename, 'rt', encoding=self.encoding) as f:
+                for data in iter(lambda: f.read(1024 * 1024), ''):
+                    yield data
+            return
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        self.pool = safe_pool_context().Pool(self.processes)
+        # bounded window of streams in flight, so that decompressed text
+        # does not pile up when the consumer is slower than the pool
+        window = 4 * self.processes
+        pending = deque()
+        spans = iter(self.spans)
+        for span in spans:
+            pending.append(self.pool.apply_async(_decompress_job, ((self.filename,) + span,)))
+            if len(pending) == window:
+                break
+        while pending:
+            data = pending.popleft().get()
+            span = next(spans, None)
+            if span:
+                pending.append(self.pool.apply_async(_decompress_job, ((self.filename,) + span,)))
+            yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+        self.close()
+
+    def _lines(self):
+        partial = ''
+        for text in self._texts():
+            lines = (partial + text).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
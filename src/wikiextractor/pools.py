@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+#  This file is part of Tanl.
+#
+#  Tanl is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License, version 3,
+#  as published by the Free Software Foundation.
+#
+#  Tanl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# =============================================================================
+
+"""Process pools started alongside threads:
+pools that are alive while their owner runs threads, or forks processes of
+its own (e.g. the extraction workers and the mapper thread of
+extract_documents()), must not fork their processes from it, since a fork
+only copies the calling thread and may copy locks held by the others.
+"""
+
+from multiprocessing import get_context, get_all_start_methods
+
+
+def safe_pool_context():
+    """
+    :return: a multiprocessing context whose processes are started by a fork
+    server, or spawned where there is none, rather than forked from the
+    caller. Like spawned processes, they import the main module of the
+    program, which must then be guarded by if __name__ == '__main__'.
+    """
+    method = 'forkserver' if 'forkserver' in get_all_start_methods() else 'spawn'
+    return get_context(method)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+#  This file is part of Tanl.
+#
+#  Tanl is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License, version 3,
+#  as published by the Free Software Foundation.
+#
+#  Tanl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# =============================================================================
+
+"""Persistent template store:
+an SQLite file holding the parsed templates and the redirects of a dump
+snapshot, so that template definitions are collected once per snapshot
+rather than by a preprocessing pass over each dump part on every run.
+
+The store records the snapshot it belongs to, e.g. enwiki-20231101, and
+the dump parts whose templates it holds. Extraction processes open it
+read-only.
+"""
+
+import logging
+import os.path
+import pickle
+import re
+import sqlite3
+
+from .extract import Template
+
+# e.g. enwiki-20231101-pages-articles-multistream1.xml-p1p41242.bz2
+dumpNameRE = re.compile(r'(\w+?wiki)-(\d{8}|latest)-')
+
+# checksum lists published with each snapshot, e.g. enwiki-20231101-md5sums.txt
+checksumNameRE = re.compile(r'(\w+?wiki)-(\d{8}|latest)-(?:md5|sha1)sums\.txt$')
+
+
+def dump_key(filename, wiki=None):
+    """
+    :return: the name of the snapshot of dump :param filename:, e.g.
+    enwiki-20231101.
+    :param wiki: the database name of the wiki, from the <siteinfo> of the
+        dump, used when the file is not named after it.
+    For 'latest' dumps, the date is read from the md5 or sha1 checksum list
+    of the snapshot saved next to the dump, which names its files by date.
+    """
+    basename = os.path.basename(filename)
+    m = dumpNameRE.match(basename)
+    if m and m.group(2) != 'latest':
+        return '%s-%s' % m.groups()
+    wiki = wiki or (m.group(1) if m else basename.split('-')[0])
+    date = checksum_date(os.path.dirname(filename) or '.', wiki)
+    if not date:
+        raise ValueError("Can't tell the snapshot of '%s': give it explicitly, or save "
+                         "the checksum list of the dump next to it" % filename)
+    return '%s-%s' % (wiki, date)
+
+
+def checksum_date(directory, wiki):
+    """
+    :return: the date of the snapshot of :param wiki: whose checksum list is
+    in :param directory:, None if there is none.
+    """
+    for name in sorted(os.listdir(directory)):
+        m = checksumNameRE.match(name)
+        if not m or m.group(1) != wiki:
+            continue
+        if m.group(2) != 'latest':
+            return m.group(2)
+        with open(os.path.join(directory, name)) as file:
+            for line in file:
+                fields = line.split()
+                m = dumpNameRE.match(fields[-1]) if len(fields) == 2 else None
+                if m and m.group(1) == wiki and m.group(2) != 'latest':
+                    return m.group(2)
+    return None
+
+
+class TemplateStore():
+
+    """
+    Parsed templates and redirects of a snapshot, stored in an SQLite file.
+    Connections are opened on demand in each process, since they cannot be
+    shared across fork().
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.pid = None
+        self.readonly = True
+
+    def connect(self, readonly=True):
+        if self.connection and self.pid == os.getpid() and (readonly or not self.readonly):
+            return self.connection
+        if readonly:
+            connection = sqlite3.connect('file:%s?mode=ro' % self.filename, uri=True)
+        else:
+            connection = sqlite3.connect(self.filename)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS parts (name TEXT PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS templates (title TEXT PRIMARY KEY, template BLOB);
+                CREATE TABLE IF NOT EXISTS redirects (title TEXT PRIMARY KEY, target TEXT);
+            ''')
+        self.connection = connection
+        self.pid = os.getpid()
+        self.readonly = readonly
+        return connection
+
+    def open(self, snapshot):
+        """
+        Open the store for writing templates of :param snapshot:, emptying it
+        if it holds those of another snapshot.
+        :return: the set of dump parts whose templates are in the store.
+        """
+        connection = self.connect(readonly=False)
+        row = connection.execute("SELECT value FROM meta WHERE key = 'snapshot'").fetchone()
+        if not row or row[0] != snapshot:
+            if row:
+                logging.info("Template store '%s' holds snapshot %s, rebuilding it for %s.",
+                             self.filename, row[0], snapshot)
+            with connection:
+                for table in ('parts', 'templates', 'redirects'):
+                    connection.execute('DELETE FROM %s' % table)
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('snapshot', ?)", (snapshot,))
+        return self.parts()
+
+    def parts(self):
+        """
+        :return: the set of dump parts whose templates are in the store.
+        """
+        return set(row[0] for row in self.connect().execute('SELECT name FROM parts'))
+
+    def add(self, templates, redirects, part):
+        """
+        Parse and store :param templates:, a dict of template bodies, and
+        :param redirects:, collected from dump :param part:.
+        """
+        connection = self.connect(readonly=False)
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO templates VALUES (?, ?)',
+                                   ((title, pickle.dumps(Template.parse(body), pickle.HIGHEST_PROTOCOL))
+                                    for title, body in templates.items()))
+            connection.executemany('INSERT OR REPLACE INTO redirects VALUES (?, ?)',
+                                   redirects.items())
+            connection.execute('INSERT OR REPLACE INTO parts VALUES (?)', (part,))
+        logging.info("Stored %d templates and %d redirects from '%s' in '%s'",
+                     len(templates), len(redirects), part, self.filename)
+
+    def template(self, title):
+        """
+        :return: the parsed template called :param title:, None if not defined.
+        """
+        row = self.connect().execute('SELECT template FROM templates WHERE title = ?', (title,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def redirect(self, title):
+        """
+        :return: the title :param title: redirects to, None if it is no redirect.
+        """
+        row = self.connect().execute('SELECT target FROM redirects WHERE title = ?', (title,)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM templates').fetchone()[0]
+
+    def close(self):
+        if self.connection and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
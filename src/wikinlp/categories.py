@@ -1,14 +1,52 @@
 #!/usr/bin/python3
 
 import requests
-import re
 from time import sleep
 import inspect, os
 from os.path import join, exists
-import pickle
 import requests
 from pathlib import Path
-from nltk.tokenize import word_tokenize
+from wikinlp.tokenizers import get_tokenizer, OrderedStage
+from wikinlp.sections import SectionFilter
+
+
+class PageFormatter:
+    '''Turns the extract of a page returned by the API into its corpus version.
+    Formatters are sent to the processes of an OrderedStage, so the tokenizer
+    is only loaded in each process.'''
+
+    def __init__(self, doctags=True, tokenize=False, lower=False, sections=None, minlength=50, tokenizer='nltk', spm_model=None):
+        self.doctags = doctags
+        self.tokenize = tokenize
+        self.lower = lower
+        self.section_filter = SectionFilter(sections, ignorecase=True) if sections else None
+        self.minlength = minlength
+        self.tokenizer = tokenizer
+        self.spm_model = spm_model
+
+    def format_batch(self, pages):
+        return [self.format(docstart, extract) for docstart, extract in pages]
+
+    def format(self, docstart, extract):
+        '''Return the corpus version of the page, or the empty string if it is
+        too short.'''
+        if self.section_filter:
+            extract = self.section_filter.filter(extract)
+        if extract == '':
+            return ''
+        if self.tokenize:
+            tokenizer = get_tokenizer(self.tokenizer, self.spm_model)
+            extract = ''.join([' '.join(tokenizer.tokenize(l))+'\n' for l in extract.split('\n') if l != ''])
+        else:
+            extract = ''.join([l+'\n' for l in extract.split('\n') if l != ''])
+        if self.lower:
+            extract = extract.lower()
+        if len(extract.split()) <= self.minlength:
+            return ''
+        if self.doctags:
+            extract = docstart+extract+"</doc>\n"
+        return extract
+
 
 class CatProcessor:
 
@@ -136,24 +174,14 @@ class CatProcessor:
 
 
     def extract_sections(self, docstr, sections):
-        tmp = ""
-        write = False
-        for l in docstr.split('\n'):
-            m1 = re.search('^\s*==',l)
-            m2 = re.search('^\s*##',l)
-            if (m1 or m2) and write:
-                write = False
-            if write:
-                tmp+=l+'\n'
-            for section in sections:
-                m1 = re.search('==\s*'+section+'\s*==',l, re.IGNORECASE)
-                m2 = re.search('##\s*'+section,l, re.IGNORECASE)
-                if m1 or m2:
-                    write=True
-        return tmp
-
-
-    def get_page_content(self, categories, doctags=True, tokenize=False, lower=False, sections=None, minlength=50, sleep_between_cats=10, override=False):
+        return SectionFilter(sections, ignorecase=True).filter(docstr)
+
+
+    def get_page_content(self, categories, doctags=True, tokenize=False, lower=False, sections=None, minlength=50, sleep_between_cats=10, override=False, tokenizer='nltk', spm_model=None, processes=1):
+        '''Write a corpus for each category. Pages are tokenized with tokenizer:
+        'nltk', 'regex' or 'spm', the latter with the SentencePiece model at
+        spm_model. With processes > 1, pages are formatted in that many processes
+        while the next ones are being downloaded.'''
         def read_titles(filename):
             IDs = []
             titles = []
@@ -170,6 +198,7 @@ class CatProcessor:
 
         print("\n---> WikiCategories: downloading content of pages for selected categories")
         S = requests.Session()
+        formatter = PageFormatter(doctags=doctags, tokenize=tokenize, lower=lower, sections=sections, minlength=minlength, tokenizer=tokenizer, spm_model=spm_model)
 
         for cat in categories:
             print("\t>> Processing category",cat)
@@ -197,6 +226,7 @@ class CatProcessor:
             sleep(sleep_between_cats)
             print("\t>> Processing now...")
             content_file = open(output_path,'w')
+            stage = OrderedStage(formatter.format_batch, content_file.write, processes)
 
             for i in range(len(titles)):
                 PARAMS = {
@@ -215,31 +245,11 @@ class CatProcessor:
 
                 for page in PAGES:
                     docstart = ""
-                    extract = PAGES[page]["extract"]
-                    if sections:
-                        extract = self.extract_sections(extract,sections)
-                    if extract == '':
-                        continue
                     if doctags:
                         docstart = "<doc url=\"https://"+self.lang+".wikipedia.org/wiki/?curid="+IDs[i]+"\" id=\""+IDs[i]+"\" title=\""+titles[i]+"\">\n"
-                    tmp = ""
-                    for l in extract.split('\n'):
-                        if l != '':
-                            if tokenize:
-                                tmp+= ' '.join(word_tokenize(l))+'\n'
-                            else:
-                                tmp+=l+'\n'
-                    extract = tmp
-                    if lower:
-                        extract = extract.lower()
-
-                    if len(extract.split()) > minlength:
-                        if doctags:
-                            content_file.write(docstart)
-                        content_file.write(extract)
-                        if doctags:
-                            content_file.write("</doc>\n")
+                    stage.put((docstart, PAGES[page]["extract"]))
 
+            stage.close()
             content_file.close()
             print("\t>> Your preprocessed corpus is at", output_path)
             corpora.append(output_path)
@@ -0,0 +1,174 @@
+import mmap
+from array import array
+
+#File layout: the magic string, the offsets of the sections, then the sections
+#themselves, aligned to 8 bytes. Arrays are stored in the byte order of the
+#machine that wrote the index.
+MAGIC = b'WNCATS01'
+SECTIONS = [('title_offsets','Q'), ('doc_offsets','Q'), ('doc_lengths','Q'), ('page_ptr','Q'), ('page_cats','I'), ('name_offsets','Q'), ('cat_ptr','Q'), ('cat_pages','I'), ('title_order','I'), ('name_order','I'), ('titles','B'), ('names','B')]
+
+
+class CategoryIndexWriter:
+    '''Builds the category index of a dump part or linear corpus. Category names
+    are interned: each page only holds the ids of its categories. When the index
+    is written, the category to pages lists are derived from the page to
+    categories ones.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.titles = []
+        self.doc_offsets = array('Q')
+        self.doc_lengths = array('Q')
+        self.page_ptr = array('Q', [0])
+        self.page_cats = array('I')
+        self.cat_ids = {}
+
+    def add(self, title, categories, offset=0, length=0):
+        '''Record the categories of page title, whose document is at offset in the
+        linear corpus and takes up length bytes (0 if it was left out).'''
+        self.titles.append(title)
+        self.doc_offsets.append(offset)
+        self.doc_lengths.append(length)
+        #A category can be given twice, e.g. by a template and by a link
+        for c in dict.fromkeys(categories):
+            if c not in self.cat_ids:
+                self.cat_ids[c] = len(self.cat_ids)
+            self.page_cats.append(self.cat_ids[c])
+        self.page_ptr.append(len(self.page_cats))
+
+    def close(self):
+        names = list(self.cat_ids)
+        #Category to pages, by counting sort of the page to categories lists
+        cat_ptr = array('Q', bytes(8 * (len(names) + 1)))
+        for c in self.page_cats:
+            cat_ptr[c + 1] += 1
+        for c in range(len(names)):
+            cat_ptr[c + 1] += cat_ptr[c]
+        fill = array('Q', cat_ptr[:-1])
+        cat_pages = array('I', bytes(4 * len(self.page_cats)))
+        for page in range(len(self.titles)):
+            for c in self.page_cats[self.page_ptr[page]:self.page_ptr[page + 1]]:
+                cat_pages[fill[c]] = page
+                fill[c] += 1
+        title_offsets, titles = self.blob(self.titles)
+        name_offsets, names_blob = self.blob(names)
+        sections = dict(title_offsets=title_offsets, doc_offsets=self.doc_offsets, doc_lengths=self.doc_lengths,
+                        page_ptr=self.page_ptr, page_cats=self.page_cats, name_offsets=name_offsets,
+                        cat_ptr=cat_ptr, cat_pages=cat_pages,
+                        title_order=array('I', sorted(range(len(self.titles)), key=self.titles.__getitem__)),
+                        name_order=array('I', sorted(range(len(names)), key=names.__getitem__)),
+                        titles=titles, names=names_blob)
+        with open(self.filename, 'wb') as f:
+            position = len(MAGIC) + 8 * 2 * len(SECTIONS)
+            table = array('Q')
+            for name, _ in SECTIONS:
+                position += -position % 8
+                size = len(sections[name]) * sections[name].itemsize
+                table.extend([position, len(sections[name])])
+                position += size
+            f.write(MAGIC)
+            f.write(table.tobytes())
+            for name, _ in SECTIONS:
+                f.write(bytes(-f.tell() % 8))
+                f.write(sections[name].tobytes())
+
+    def blob(self, strings):
+        '''Return the offsets of the encoded strings in their concatenation, and
+        the concatenation.'''
+        offsets = array('Q', [0])
+        data = array('B')
+        for s in strings:
+            data.frombytes(s.encode('utf-8'))
+            offsets.append(len(data))
+        return offsets, data
+
+
+class CategoryIndex:
+    '''Read-only view of a category index, mapped in memory rather than loaded.
+    index[title] returns the categories of a page, like the dicts pickled by
+    get_categories used to.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("Not a category index: "+filename)
+        view = memoryview(self.map)
+        table = view[len(MAGIC):len(MAGIC) + 8 * 2 * len(SECTIONS)].cast('Q')
+        self.views = [view, table]
+        for i, (name, typecode) in enumerate(SECTIONS):
+            start, length = table[2 * i], table[2 * i + 1]
+            section = view[start:start + length * array(typecode).itemsize].cast(typecode)
+            self.views.append(section)
+            setattr(self, name, section)
+
+    def __len__(self):
+        return len(self.doc_offsets)
+
+    def __contains__(self, title):
+        return self.find(title) is not None
+
+    def __getitem__(self, title):
+        page = self.find(title)
+        if page is None:
+            raise KeyError(title)
+        return self.page_categories(page)
+
+    def title(self, page):
+        return bytes(self.titles[self.title_offsets[page]:self.title_offsets[page + 1]]).decode('utf-8')
+
+    def name(self, cat):
+        return bytes(self.names[self.name_offsets[cat]:self.name_offsets[cat + 1]]).decode('utf-8')
+
+    def find(self, title):
+        '''Return the id of page title, or None.'''
+        return self.search(self.title_order, self.title, title)
+
+    def find_category(self, category):
+        '''Return the id of category, or None.'''
+        return self.search(self.name_order, self.name, category)
+
+    def search(self, order, key, value):
+        '''Binary search of value among the keys of the ids in order.'''
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(order[mid]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and key(order[lo]) == value:
+            return order[lo]
+        return None
+
+    def page_categories(self, page):
+        return [self.name(c) for c in self.page_cats[self.page_ptr[page]:self.page_ptr[page + 1]]]
+
+    def category_pages(self, category):
+        '''Return the ids of the pages in category.'''
+        cat = self.find_category(category)
+        if cat is None:
+            return []
+        return list(self.cat_pages[self.cat_ptr[cat]:self.cat_ptr[cat + 1]])
+
+    def pages(self, category):
+        '''Return the titles of the pages in category.'''
+        return [self.title(page) for page in self.category_pages(category)]
+
+    def documents(self, category):
+        '''Return the offset and length in the linear corpus of the documents of
+        the pages in category, leaving out those that were not written.'''
+        return [(self.doc_offsets[page], self.doc_lengths[page]) for page in self.category_pages(category) if self.doc_lengths[page]]
+
+    def categories(self):
+        '''Return the names of all categories, with their number of pages.'''
+        return [(self.name(cat), self.cat_ptr[cat + 1] - self.cat_ptr[cat]) for cat in range(len(self.cat_ptr) - 1)]
+
+    def close(self):
+        for view in reversed(getattr(self, 'views', [])):
+            view.release()
+        self.views = []
+        self.map.close()
+        self.file.close()
@@ -1,26 +1,54 @@
 import re
 import bz2
 import pickle
+import hashlib
 import requests
 import inspect, os
+import threading
+from collections import deque
+from glob import glob
 from pathlib import Path
 from os.path import join, exists
+from urllib.parse import urlparse
+from multiprocessing import cpu_count, get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from nltk.tokenize import word_tokenize
-from wikiextractor.WikiExtractor import process_wiki
+from wikiextractor.WikiExtractor import process_wiki, extract_documents
+from wikinlp.tokenizers import get_tokenizer, OrderedStage
+from wikinlp.sections import SectionFilter, SectionIndex
+from wikinlp.catindex import CategoryIndexWriter, CategoryIndex
 
 
 class Downloader:
 
-    def __init__(self,lang=None):
+    def __init__(self,lang=None, concurrency=2, max_per_host=2, dumps_url='https://dumps.wikimedia.org/'):
         self.lang = lang
+        self.concurrency = concurrency #Number of dump parts downloaded at the same time
+        self.max_per_host = max_per_host #Connection cap per host, Wikimedia throttles above 2-3
+        self.dumps_url = dumps_url
+        self.host_slots = {}
+        self.host_lock = threading.Lock()
+        self.stop_downloads = threading.Event() #Set when processing fails, to drop the downloads in progress
         filename = inspect.getframeinfo(inspect.currentframe()).filename
         self.path = os.path.dirname(os.path.abspath(filename))
 
-    def mk_wiki_data(self, n_dump_files = None, start_from = 0, doctags=True, tokenize=False, lower=True, sections=None):
+    def mk_wiki_data(self, n_dump_files = None, start_from = 0, doctags=True, tokenize=False, lower=True, sections=None, stream=False, parallel_parts=1, cpu_budget=None, disk_budget=None, tokenizer='nltk', spm_model=None, tokenize_processes=1):
+        '''Download and process dump parts. With parallel_parts > 1, that many parts
+        are processed at the same time, each in its own process. The processes of
+        the parts, tokenization ones included, share a total of cpu_budget CPUs (all
+        of them by default), and parts are only started while the disk space their decompressed
+        XML is expected to take up fits in disk_budget bytes (no limit by default).
+        Part processes are spawned, so they import the main module of the program:
+        scripts calling mk_wiki_data with parallel_parts > 1 must guard their code
+        with if __name__ == '__main__'.
+        Documents are tokenized with tokenizer: 'nltk', 'regex' or 'spm', the latter
+        with the SentencePiece model at spm_model. Tokenization, lowercasing and
+        section filtering run in tokenize_processes processes for each part.'''
         processed_dir = join(os.getcwd(),join('data',self.lang))
         Path(processed_dir).mkdir(exist_ok=True, parents=True)
 
         link_file = self.get_wiki_links()
+        self.get_checksum_lists(processed_dir)
         wiki_paths = self.read_wiki_links()
         linear_filenames = []
 
@@ -29,22 +57,229 @@ class Downloader:
         else:
             n = min(n_dump_files, len(wiki_paths))
 
-        for i in range(start_from,start_from+n):
-            wiki_path = wiki_paths[i]
-            print("\n---> WikiNLP: downloading ", wiki_path, "(dump file",i+1,")")
-            bz2_file = join(processed_dir,wiki_path.split('/')[-1])
-            if exists(bz2_file):
-                print("     File already exists. Skipping download.")
+        settings = dict(doctags=doctags, tokenize=tokenize, lower=lower, sections=sections, stream=stream, tokenizer=tokenizer, spm_model=spm_model, tokenize_processes=tokenize_processes)
+        if parallel_parts > 1:
+            settings['processes'] = self.part_processes(cpu_budget or cpu_count(), parallel_parts, stream, tokenize_processes)
+
+        #Parts are downloaded in the background while earlier ones are being processed,
+        #a few parts ahead, so that little is downloaded in vain if processing fails.
+        self.stop_downloads.clear()
+        pool = ThreadPoolExecutor(max_workers=max(1, self.concurrency))
+        submitted = []
+        downloads = self.prefetch(pool, submitted, wiki_paths, processed_dir, range(start_from,start_from+n), max(1, self.concurrency))
+        try:
+            if parallel_parts <= 1:
+                for download in downloads:
+                    linear_filenames.append(self.process_part(download.result(), **settings))
+                return linear_filenames
+
+            disk = DiskBudget(disk_budget) if disk_budget else None
+            #Parts run in processes of their own, spawned rather than forked from this multithreaded one.
+            with ThreadPoolExecutor(max_workers=parallel_parts) as scheduler, \
+                 ProcessPoolExecutor(max_workers=parallel_parts, mp_context=get_context('spawn')) as workers:
+                jobs = deque()
+                for download in downloads:
+                    jobs.append(scheduler.submit(self.schedule_part, download, workers, disk, settings))
+                    if len(jobs) >= parallel_parts:
+                        linear_filenames.append(jobs.popleft().result())
+                while jobs:
+                    linear_filenames.append(jobs.popleft().result())
+            return linear_filenames
+        except BaseException:
+            #Drop the queued downloads and interrupt those in progress, rather than waiting for them.
+            self.stop_downloads.set()
+            for download in submitted:
+                download.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=not self.stop_downloads.is_set())
+
+    def part_processes(self, cpu_budget, parallel_parts, stream, tokenize_processes):
+        '''Number of extraction processes of each of parallel_parts parts, so that
+        all the processes of the parts fit in cpu_budget CPUs. Besides extraction
+        processes, a part has one process reading the dump and, unless streaming,
+        one writing the extracted text. Its tokenize_processes run along with
+        extraction when streaming, and after it otherwise.'''
+        share = cpu_budget // parallel_parts
+        tokenizers = tokenize_processes if tokenize_processes > 1 else 0 #A single one runs in the reading process
+        others = 1 + (tokenizers if stream else 1)
+        if share < others + 1 or share < tokenizers + 1:
+            raise ValueError("A CPU budget of %d is too small for %d parts: each needs at least %d CPUs." % (cpu_budget, parallel_parts, max(others, tokenizers) + 1))
+        return share - others
+
+    def prefetch(self, pool, submitted, wiki_paths, processed_dir, parts, lookahead):
+        '''Yield the downloads of parts in order, submitting each one to pool when
+        the download lookahead parts before it is yielded. Submitted downloads are
+        appended to submitted.'''
+        pending = deque()
+        for i in parts:
+            pending.append(pool.submit(self.fetch_part, wiki_paths[i], processed_dir, i))
+            submitted.append(pending[-1])
+            if len(pending) > lookahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def schedule_part(self, download, workers, disk, settings):
+        '''Wait for a part to be downloaded and for disk space to be available, then
+        process it in one of the workers.'''
+        bz2_file = download.result()
+        size = 0 if settings['stream'] else XML_RATIO * os.path.getsize(bz2_file)
+        if disk:
+            disk.acquire(size)
+        try:
+            return workers.submit(process_part, self.lang, self.dumps_url, bz2_file, settings).result()
+        finally:
+            if disk:
+                disk.release(size)
+
+    def process_part(self, bz2_file, stream=False, **settings):
+        if stream:
+            return self.mk_linear_stream(bz2_file, **settings)
+        self.extract_xml(bz2_file)
+        return self.mk_linear(bz2_file, **settings)
+
+    def fetch_part(self, wiki_path, processed_dir, i=0):
+        bz2_file = join(processed_dir,wiki_path.split('/')[-1])
+        if exists(bz2_file):
+            print("\n---> WikiNLP: dump file",i+1,"already exists. Skipping download.")
+            return bz2_file
+        print("\n---> WikiNLP: downloading ", wiki_path, "(dump file",i+1,")")
+        with self.host_slot(wiki_path):
+            self.download(wiki_path, bz2_file)
+        print("     Finished downloading dump file",i+1)
+        return bz2_file
+
+    def host_slot(self, url):
+        '''Semaphore limiting the number of simultaneous connections to the host of url.'''
+        host = urlparse(url).netloc
+        with self.host_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(max(1, self.max_per_host))
+            return self.host_slots[host]
+
+    def download(self, url, filepath, chunk_size=1024*1024, max_retries=5):
+        '''Stream url to filepath through a .part file, resuming interrupted
+        transfers with HTTP Range requests. The ETag or Last-Modified date of the
+        file is saved next to the .part file and sent back in If-Range, so that
+        the server sends the whole file again if it has changed since. The .part
+        file is only renamed once its size, and its checksum when one is
+        published, have been verified.'''
+        part_file = filepath+'.part'
+        validator_file = part_file+'.validator'
+        total = None
+        retries = 0
+        while True:
+            offset = os.path.getsize(part_file) if exists(part_file) else 0
+            validator = open(validator_file).read() if exists(validator_file) else ''
+            if offset and not validator: #Nothing to tell whether the .part file is still current
+                print("     Cannot check", part_file, "against the remote file. Downloading again.")
+                offset = 0
+            headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator} if offset else {}
+            try:
+                with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+                    if r.status_code == 416: #Nothing left to fetch, if the .part file is complete
+                        total = self.remote_size(url, r)
+                        if total == offset:
+                            break
+                        print("     Unexpected size of", part_file, "(", offset, "bytes, expected", total, "). Downloading again.")
+                        os.remove(part_file)
+                        continue
+                    r.raise_for_status()
+                    if offset and r.status_code != 206: #The file changed, or the server ignored the range: start over
+                        offset = 0
+                    if 'Content-Range' in r.headers:
+                        total = int(r.headers['Content-Range'].split('/')[-1])
+                    elif 'Content-Length' in r.headers:
+                        total = offset + int(r.headers['Content-Length'])
+                    if offset:
+                        print("     Resuming download at byte", offset)
+                    else:
+                        with open(validator_file, 'w') as f:
+                            f.write(r.headers.get('ETag') or r.headers.get('Last-Modified') or '')
+                    with open(part_file, 'ab' if offset else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            if self.stop_downloads.is_set(): #The .part file is resumed next time
+                                raise IOError("Download of %s interrupted." % url)
+                            f.write(chunk)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                retries += 1
+                if retries > max_retries:
+                    raise
+                print("     Connection dropped (", e, "). Retrying", retries, "of", max_retries)
+
+        size = os.path.getsize(part_file)
+        if total is not None and size != total:
+            raise IOError("Incomplete download of %s: got %d bytes, expected %d." % (url, size, total))
+        self.verify_checksum(part_file, os.path.dirname(filepath), url.split('/')[-1])
+        os.replace(part_file, filepath)
+        if exists(validator_file):
+            os.remove(validator_file)
+        return filepath
+
+    def remote_size(self, url, response):
+        '''Size of the file at url, from the Content-Range of a 416 response
+        (bytes */size) or else from a HEAD request. None if unknown.'''
+        m = re.match(r'bytes \*/(\d+)', response.headers.get('Content-Range', ''))
+        if m:
+            return int(m.group(1))
+        r = requests.head(url, allow_redirects=True, timeout=60)
+        if r.ok and 'Content-Length' in r.headers:
+            return int(r.headers['Content-Length'])
+        return None
+
+    def get_checksum_lists(self, dump_dir):
+        '''Save the md5 and sha1 lists published with the latest dump next to the
+        dump files, where the template store of wikiextractor also reads the date
+        of the snapshot from them.'''
+        latest_url = self.dumps_url+self.lang+'wiki/latest/'
+        for algo in ['md5', 'sha1']:
+            filename = self.lang+"wiki-latest-"+algo+"sums.txt"
+            r = requests.get(latest_url+filename, timeout=60)
+            if r.ok:
+                with open(join(dump_dir,filename),'w') as f:
+                    f.write(r.text)
             else:
-                with open (join(processed_dir,bz2_file), "wb") as f:
-                    f.write(requests.get(wiki_path).content)
+                print("     No", algo, "checksum list published for", self.lang+"wiki.")
+
+    def read_checksums(self, dump_dir):
+        '''Read the sha1 or md5 lists saved next to the dump files. The lists name
+        files after the date of the snapshot (e.g. enwiki-20231101-pages-articles1.xml...)
+        rather than 'latest', so checksums are keyed by the part of the name after
+        the snapshot.'''
+        checksums = {}
+        for algo in ['md5', 'sha1']:
+            filename = join(dump_dir,self.lang+"wiki-latest-"+algo+"sums.txt")
+            if not exists(filename):
+                continue
+            for l in open(filename):
+                fields = l.split()
+                if len(fields) == 2:
+                    checksums[self.dump_suffix(fields[1])] = (algo, fields[0])
+        return checksums
 
-            self.extract_xml(bz2_file)
-            self.get_categories(bz2_file)
-            cat_file = bz2_file.replace('bz2','cats.pkl')
-            lf = self.mk_linear(bz2_file, cat_file, doctags=doctags, tokenize=tokenize, lower=lower, sections=sections)
-            linear_filenames.append(lf)
-        return linear_filenames
+    def dump_suffix(self, dump_name):
+        '''Name of a dump file without its wiki and snapshot fields.'''
+        m = re.match(r'\w+?wiki-(?:\d{8}|latest)-(.*)', dump_name)
+        return m.group(1) if m else dump_name
+
+    def verify_checksum(self, filepath, dump_dir, dump_name):
+        checksums = self.read_checksums(dump_dir)
+        if not checksums:
+            print("     No checksum list saved in", dump_dir, "-", dump_name, "was not verified.")
+            return
+        if self.dump_suffix(dump_name) not in checksums:
+            raise IOError("%s is not in the checksum list of the dump." % dump_name)
+        algo, expected = checksums[self.dump_suffix(dump_name)]
+        h = hashlib.new(algo)
+        with open(filepath, 'rb') as f:
+            for data in iter(lambda : f.read(1024 * 1024), b''):
+                h.update(data)
+        if h.hexdigest() != expected:
+            os.remove(filepath)
+            raise IOError("Checksum mismatch for %s (%s)." % (dump_name, algo))
+        print("     Verified", algo, "checksum.")
 
     def bz2_uncompress(self, filepath):
         print("     Uncompressing downloaded bz2:",filepath,"---")
@@ -60,7 +295,8 @@ class Downloader:
 
     def get_wiki_links(self):
         print("\n---> WikiNLP: Getting wiki links for download.")
-        html = requests.get(url = 'https://dumps.wikimedia.org/'+self.lang+'wiki/latest/').text
+        latest_url = self.dumps_url+self.lang+'wiki/latest/'
+        html = requests.get(url = latest_url).text
         match = re.findall(self.lang+'wiki-latest-pages-articles[0-9]*\.xml-p[0-9]*p[0-9]*\.bz2', html)
         if len(match) == 0:
             match = re.findall(self.lang+'wiki-latest-pages-articles.xml.bz2', html) #For wikis with only one dump file.
@@ -71,23 +307,19 @@ class Downloader:
         outf = open(filename,'w')
 
         if len(match) > 1:
-            for i in range(1, len(match)): #Ordering list
+            for i in range(1, len(match)+1): #Ordering list
                 r = re.compile(".*articles"+str(i)+"\.xml.*")
-                urls = list(filter(r.match,match))
+                urls = sorted(filter(r.match,match), key=lambda url: int(re.search('xml-p([0-9]*)p',url).group(1)))
                 for url in urls:
-                    outf.write("https://dumps.wikimedia.org/"+self.lang+"wiki/latest/"+url+"\n")
+                    outf.write(latest_url+url+"\n")
         else:
-            outf.write("https://dumps.wikimedia.org/"+self.lang+"wiki/latest/"+match[0]+"\n")
+            outf.write(latest_url+match[0]+"\n")
             
         outf.close()
         print("     Finished!")
         return filename
 
-    def get_categories(self, bz2_file):
-        print("\n---> WikiNLP: Get categories from corpus ---")
-        xml_file = bz2_file.replace('bz2','xml')
-        all_categories = {}
-
+    def get_category_name(self):
         #Read file with translations of 'category'
         cattransl = ""
         for l in open(join(self.path,"./static/wiki_markup_info.txt")):
@@ -96,23 +328,41 @@ class Downloader:
             if fields[0] == self.lang:
                 cattransl = fields[1]
                 break
+        return cattransl
 
-        title = ""
+    def get_categories(self, bz2_file):
+        '''Read the categories of the pages of the XML version of the corpus into a
+        CategoryIndex, saved as the .cats file of the part. Categories are also
+        collected while extracting the corpus, so this is only needed to index
+        a part without extracting it.'''
+        print("\n---> WikiNLP: Get categories from corpus ---")
+        xml_file = bz2_file.replace('bz2','xml')
+        cat_file = bz2_file.replace('bz2','cats')
+        category_index = CategoryIndexWriter(cat_file)
+
+        cattransl = self.get_category_name()
+
+        title = None
+        categories = []
         f=open(xml_file,'r')
         for l in f:
             l.rstrip('\n')
             if "<title" in l:
+                if title is not None:
+                    category_index.add(title, categories)
                 m = re.search('<title>([^<]*)<',l)
                 title = m.group(1)
-                all_categories[title] = []
+                categories = []
             if '[['+cattransl+':' in l:
                 m = re.search('\[\['+cattransl+':([^\]]*)\]\]',l)
                 if m:
                     cat = m.group(1)
-                    all_categories[title].append(cat)
-        pklf = bz2_file.replace('bz2','cats.pkl')
-        with open(pklf, 'wb') as f:
-            pickle.dump(all_categories,f)
+                    categories.append(cat)
+        if title is not None:
+            category_index.add(title, categories)
+        f.close()
+        category_index.close()
+        return cat_file
 
 
     def extract_xml(self, bz2_file):
@@ -140,31 +390,9 @@ class Downloader:
         out_file.close()
 
     def extract_sections(self, docstr, sections):
-        tmp = ""
-        write = False
-        for l in docstr.split('\n'):
-            m1 = re.search('^\s*==',l)
-            m2 = re.search('^\s*##',l)
-            if (m1 or m2) and write:
-                write = False
-            if write:
-                tmp+= ' '.join(word_tokenize(l))+'\n'
-            for section in sections:
-                m1 = re.search('==\s*'+section+'\s*==',l)
-                m2 = re.search('##\s*'+section,l)
-                if m1 or m2:
-                    write=True
-        return tmp
-
-    def mk_linear(self, bz2_file, cat_file, doctags=True, tokenize=False, lower=False, sections=None):
-        print("\n---> WikiNLP: Generating linear version of corpus ---")
-
-        xml_file = bz2_file.replace('bz2','xml')
-        tmp_linear_file = bz2_file.replace('bz2','raw.tmp')
-        process_wiki(dumpfile=xml_file,outfile=tmp_linear_file)
+        return SectionFilter(sections).filter(docstr, word_tokenize)
 
-        all_categories = pickle.load(open(cat_file,'rb'))
-        tmpf = open(tmp_linear_file,'r')
+    def linear_suffix(self, doctags=True, tokenize=False, lower=False, sections=None):
         suffix = 'txt'
         if tokenize:
             suffix = 'tok.'+suffix
@@ -174,48 +402,285 @@ class Downloader:
             suffix = 'doc.'+suffix
         if sections:
             suffix = sections[0].lower()+'.'+suffix
+        return suffix
+
+    def mk_linear(self, bz2_file, cat_file=None, doctags=True, tokenize=False, lower=False, sections=None, processes=None, tokenizer='nltk', spm_model=None, tokenize_processes=1):
+        '''Extract the XML version of the corpus and write its linear version. The
+        categories of each page are collected by the extractor, unless cat_file,
+        the category index from get_categories (or the pickled dict of earlier
+        versions), is given.'''
+        print("\n---> WikiNLP: Generating linear version of corpus ---")
+
+        xml_file = bz2_file.replace('bz2','xml')
+        tmp_linear_file = bz2_file.replace('bz2','raw.tmp')
+        all_categories = None
+        if cat_file:
+            process_wiki(dumpfile=xml_file,outfile=tmp_linear_file,processes=processes)
+            if cat_file.endswith('.pkl'):
+                all_categories = pickle.load(open(cat_file,'rb'))
+            else:
+                all_categories = CategoryIndex(cat_file)
+        else:
+            process_wiki(dumpfile=xml_file,outfile=tmp_linear_file,processes=processes,categories=self.get_category_name() or True)
+        tmpf = open(tmp_linear_file,'r')
+        suffix = self.linear_suffix(doctags=doctags, tokenize=tokenize, lower=lower, sections=sections)
         linear_filename = tmp_linear_file.replace('tmp',suffix)
-        linear_file = open(linear_filename,'w')
-        doc = ''
-        startline = ''
+        linear_file = LinearWriter(self, linear_filename, all_categories, doctags=doctags, tokenize=tokenize, lower=lower, sections=sections, tokenizer=tokenizer, spm_model=spm_model, processes=tokenize_processes)
         for l in tmpf:
-            m1 = re.search('^\s*==',l)
-            m2 = re.search('^\s*##',l)
-            if (m1 or m2) and not doctags:
-                continue
-            if '<doc' in l:
-                m = re.search('.*title="([^"]*)">',l)
-                title = m.group(1)
-                categories = all_categories[title] 
-                cs = ' categories="'+'|'.join([c for c in categories])+'"'
-                startline = l.replace('>',cs+'>\n')
-            elif '</doc' in l: 
-                if sections:
-                    doc = self.extract_sections(doc,sections)
-                if doc == '':
-                    continue
-                if tokenize:
-                    tmp = ""
-                    for l in doc.split('\n'):
-                        if l != '' and not l.isspace():
-                            tmp+= ' '.join(word_tokenize(l))+'\n'
-                    doc = tmp
-                if lower:
-                    doc = doc.lower()
-                doc+='\n'
-                if doctags:
-                    linear_file.write(startline)
-                linear_file.write(doc)
-                if doctags:
-                    linear_file.write('</doc>\n')
-                doc = ''
-            else:
-                doc+=l+'\n'
+            linear_file.write_line(l)
         linear_file.close()
         tmpf.close()
+        if isinstance(all_categories, CategoryIndex):
+            all_categories.close()
         os.remove(tmp_linear_file)
         os.remove(xml_file)
         print("\n---> WikiNLP: your preprocessed corpus is at", linear_filename)
         return linear_filename
 
+    def mk_linear_stream(self, bz2_file, doctags=True, tokenize=False, lower=False, sections=None, processes=None, tokenizer='nltk', spm_model=None, tokenize_processes=1):
+        '''Single pass version of extract_xml + mk_linear: the bz2 file is
+        decompressed on the fly and extracted documents go straight to the linear
+        corpus.'''
+        print("\n---> WikiNLP: Generating linear version of corpus in a single pass ---")
+
+        suffix = self.linear_suffix(doctags=doctags, tokenize=tokenize, lower=lower, sections=sections)
+        linear_filename = bz2_file.replace('bz2','raw.'+suffix)
+        linear_file = LinearWriter(self, linear_filename, doctags=doctags, tokenize=tokenize, lower=lower, sections=sections, tokenizer=tokenizer, spm_model=spm_model, processes=tokenize_processes)
+        for document in extract_documents(bz2_file, processes=processes, categories=self.get_category_name() or True):
+            linear_file.write_document(document)
+        linear_file.close()
+        print("\n---> WikiNLP: your preprocessed corpus is at", linear_filename)
+        return linear_filename
+
+    def mk_linear_sections(self, linear_filename, sections, tokenize=False, lower=False, tokenizer='nltk', spm_model=None):
+        '''Make a corpus of some sections out of a whole corpus with <doc> tags,
+        made earlier by mk_linear or mk_linear_stream. Only the documents with one
+        of the sections, according to the section index of the corpus, are read.
+        The result is the same as extracting the sections from the dump, provided
+        the whole corpus was not tokenized. Section titles are matched regardless
+        of case in lowercased corpora.'''
+        print("\n---> WikiNLP: Extracting sections from linear corpus ---")
+        prefix, suffix = linear_filename.rsplit('.raw.', 1)
+        lowered = 'low.' in suffix
+        section_filename = prefix+'.raw.'+self.linear_suffix(tokenize=tokenize or 'tok.' in suffix, lower=lower or lowered, sections=sections)
+        linearizer = Linearizer(tokenize=tokenize, lower=lower, sections=sections, tokenizer=tokenizer, spm_model=spm_model)
+        linearizer.section_filter = SectionFilter(sections, ignorecase=lowered)
+        section_index = SectionIndex(linear_filename+'.sections')
+        with open(linear_filename,'rb') as f, open(section_filename,'w', encoding='utf-8') as section_file:
+            for offset, length in section_index.find(linearizer.section_filter):
+                f.seek(offset)
+                startline, text = f.read(length).decode('utf-8').split('\n\n', 1)
+                section_file.write(linearizer.linearize_text(startline+'\n\n', text[:-len('\n</doc>\n')]))
+        section_index.close()
+        print("\n---> WikiNLP: your preprocessed corpus is at", section_filename)
+        return section_filename
+
+    def mk_category_corpora(self, categories, linear_filenames=None):
+        '''Make a corpus for each category out of linear corpora made earlier, by
+        default all those in data/<lang>. Documents are looked up in the category
+        index of each corpus, so that nothing is fetched from the Wikipedia API.
+        Corpora are saved in data/<lang>/categories, as by CatProcessor, with the
+        suffix of the linear corpora they come from.'''
+        print("\n---> WikiNLP: Making category corpora from linear corpora ---")
+        processed_dir = join(os.getcwd(),join('data',self.lang))
+        if linear_filenames is None:
+            linear_filenames = sorted(f[:-len('.cats')] for f in glob(join(processed_dir,'*.raw.*.cats')))
+        outputs = {}
+        counts = dict((cat, 0) for cat in categories)
+        for linear_filename in linear_filenames:
+            suffix = linear_filename.rsplit('.raw.', 1)[1]
+            category_index = CategoryIndex(linear_filename+'.cats')
+            with open(linear_filename,'rb') as f:
+                for cat in categories:
+                    documents = category_index.documents(cat)
+                    if not documents:
+                        continue
+                    if (cat, suffix) not in outputs:
+                        cat_dir = join(processed_dir,"categories/"+cat.replace(' ','_').replace('/','_'))
+                        Path(cat_dir).mkdir(exist_ok=True, parents=True)
+                        outputs[(cat, suffix)] = open(join(cat_dir,"linear."+cat.lower().replace(' ','_').replace('/','_')+'.'+suffix),'wb')
+                    for offset, length in documents:
+                        f.seek(offset)
+                        outputs[(cat, suffix)].write(f.read(length))
+                    counts[cat] += len(documents)
+            category_index.close()
+        for output in outputs.values():
+            output.close()
+        for cat in categories:
+            print("\t>>",counts[cat],"documents found for category",cat)
+        return sorted(output.name for output in outputs.values())
+
+
+#Uncompressed dumps are about 5 times larger than their bz2 file, and extract_xml
+#holds two copies at the peak.
+XML_RATIO = 2 * 5
+
+
+def process_part(lang, dumps_url, bz2_file, settings):
+    '''Process a downloaded part in a worker process of mk_wiki_data.'''
+    return Downloader(lang, dumps_url=dumps_url).process_part(bz2_file, **settings)
+
+
+class DiskBudget:
+    '''Bytes of disk that the parts being processed may take up at the same time.
+    A part larger than the whole budget is processed, alone.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.used and self.used + size > self.size:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class Linearizer:
+    '''Turns the lines of an extracted document into its linear corpus version.
+    Linearizers are sent to the processes of an OrderedStage, so they only hold
+    settings: the tokenizer is loaded in each process. With index_sections, the
+    titles of the sections of each document are returned with it.'''
+
+    header_re = re.compile(r'\s*(==|##)')
+
+    def __init__(self, doctags=True, tokenize=False, lower=False, sections=None, tokenizer='nltk', spm_model=None, index_sections=False):
+        self.doctags = doctags
+        self.tokenize = tokenize
+        self.lower = lower
+        self.section_filter = SectionFilter(sections) if sections else None
+        self.tokenizer = tokenizer
+        self.spm_model = spm_model
+        self.index_sections = index_sections
+
+    def linearize_batch(self, docs):
+        if self.index_sections:
+            return [(self.linearize(startline, lines), list(dict.fromkeys([l[3:].strip() for l in lines if l.startswith('## ')]))) for startline, lines in docs]
+        return [self.linearize(startline, lines) for startline, lines in docs]
+
+    def linearize(self, startline, lines):
+        '''Return the linear version of the document with header startline and body
+        lines, or the empty string if nothing is left of it.'''
+        if self.doctags:
+            doc = [l+'\n' for l in lines]
+        else:
+            doc = [l+'\n' for l in lines if not self.header_re.match(l)]
+        return self.linearize_text(startline, ''.join(doc))
+
+    def linearize_text(self, startline, text):
+        if self.tokenize or self.section_filter:
+            tokenizer = get_tokenizer(self.tokenizer, self.spm_model)
+        if self.section_filter:
+            text = self.section_filter.filter(text, tokenizer.tokenize)
+        if not text:
+            return ''
+        if self.tokenize:
+            text = ''.join([' '.join(tokenizer.tokenize(l))+'\n' for l in text.split('\n') if l != '' and not l.isspace()])
+        if self.lower:
+            text = text.lower()
+        text += '\n'
+        if self.doctags:
+            text = startline+text+'</doc>\n'
+        return text
+
+
+class LinearWriter:
+    '''File-like object turning the <doc> blocks produced by the extractor into
+    the linear corpus format. If all_categories is None, the categories are
+    expected to be in the <doc> header already. Documents are linearized in
+    batches by a pool of processes when processes > 1, and written out in order.
+    The categories of the pages and the position of their documents go to a
+    CategoryIndex, in linear_filename.cats. Whole corpora with <doc> tags also
+    get a SectionIndex, in linear_filename.sections.'''
+
+    title_re = re.compile(r'.*title="([^"]*)">')
+    header_title_re = re.compile(r' title="([^"]*)"')
+    header_categories_re = re.compile(r' categories="([^"]*)"')
+
+    def __init__(self, downloader, linear_filename, all_categories=None, doctags=True, tokenize=False, lower=False, sections=None, tokenizer='nltk', spm_model=None, processes=1):
+        self.downloader = downloader
+        self.all_categories = all_categories
+        self.linear_file = open(linear_filename,'w', encoding='utf-8')
+        self.section_filter = SectionFilter(sections) if sections else None
+        self.section_index = None
+        if doctags and not sections:
+            self.section_index = SectionIndex(linear_filename+'.sections', 'w')
+        self.category_index = CategoryIndexWriter(linear_filename+'.cats')
+        self.pages = deque() #Title and categories of the documents not written yet
+        self.offset = 0
+        linearizer = Linearizer(doctags=doctags, tokenize=tokenize, lower=lower, sections=sections, tokenizer=tokenizer, spm_model=spm_model, index_sections=self.section_index is not None)
+        self.stage = OrderedStage(linearizer.linearize_batch, self.write_result, processes)
+        self.startline = ''
+        self.lines = []
+
+    def write(self, text):
+        for l in text.splitlines(True):
+            self.write_line(l)
+
+    def write_line(self, l):
+        if '<doc' in l:
+            title = None
+            if self.all_categories is not None:
+                title = self.title_re.search(l).group(1)
+            self.start_doc(l, title)
+        elif '</doc' in l:
+            self.end_doc()
+        else:
+            self.lines.append(l)
+
+    def write_document(self, document):
+        '''Write a Document yielded by extract_documents, as if it had been
+        written in <doc> format. When filtering sections, the paragraphs of the
+        other sections are left out right away.'''
+        self.start_doc(document.header(), document.title)
+        if self.section_filter:
+            lines = self.section_filter.outline(document)
+        else:
+            lines = [document.title, '']+document.text+['']
+        self.lines = [l+'\n' for l in lines]
+        self.end_doc()
+
+    def write_result(self, result):
+        headings = None
+        if self.section_index is not None:
+            result, headings = result
+        length = len(result.encode('utf-8'))
+        title, categories = self.pages.popleft()
+        self.category_index.add(title, categories, self.offset, length)
+        if not result:
+            return
+        if headings is not None:
+            self.section_index.add(self.offset, length, headings)
+        self.offset += length
+        self.linear_file.write(result)
+
+    def start_doc(self, header, title):
+        cs = ''
+        if self.all_categories is not None:
+            categories = self.all_categories[title]
+            cs = ' categories="'+'|'.join([c for c in categories])+'"'
+        self.startline = header.replace('>',cs+'>\n')
+        self.lines = []
+
+    def end_doc(self):
+        title = self.header_title_re.search(self.startline).group(1)
+        m = self.header_categories_re.search(self.startline)
+        self.pages.append((title, m.group(1).split('|') if m and m.group(1) else []))
+        self.stage.put((self.startline, self.lines))
+        self.lines = []
+
+    def flush(self):
+        self.linear_file.flush()
 
+    def close(self):
+        self.stage.close()
+        self.linear_file.close()
+        self.category_index.close()
+        if self.section_index is not None:
+            self.section_index.close()
@@ -0,0 +1,79 @@
+import re
+
+
+class SectionFilter:
+    '''Keeps the lines of the sections whose title matches one of sections. The
+    section names are regular expressions, combined into a single one when the
+    filter is built. Headers are marked either as == Title == (API extracts) or
+    as ## Title (extracted dumps).'''
+
+    header_re = re.compile(r'\s*(==|##)')
+
+    def __init__(self, sections, ignorecase=False):
+        self.sections = sections
+        flags = re.IGNORECASE if ignorecase else 0
+        self.section_re = re.compile('|'.join(r'==\s*'+section+r'\s*==|##\s*'+section for section in sections), flags)
+
+    def matches(self, heading):
+        '''Whether a section titled heading is kept.'''
+        return self.section_re.search('## '+heading) is not None
+
+    def filter_lines(self, lines):
+        '''Yield the lines of the sections we want, without their headers.'''
+        write = False
+        for l in lines:
+            if write and self.header_re.match(l):
+                write = False
+            if write:
+                yield l
+            if self.section_re.search(l):
+                write = True
+
+    def filter(self, text, tokenize=None):
+        '''Return the lines of text in the sections we want, tokenized with the
+        tokenize function if one is given.'''
+        if tokenize is None:
+            return ''.join([l+'\n' for l in self.filter_lines(text.split('\n'))])
+        return ''.join([' '.join(tokenize(l))+'\n' for l in self.filter_lines(text.split('\n'))])
+
+    def outline(self, document):
+        '''Return the lines of an extracted Document, as LinearWriter.write_document
+        lays them out, where the paragraphs of the sections we do not want have
+        been left out. Their headers are kept, since they end the preceding
+        section, so that filter_lines gives the same result as on the whole
+        document.'''
+        lines = [document.title, '']
+        for heading, paragraphs in document.sections:
+            if not heading:
+                continue
+            lines.append('## '+heading)
+            if self.matches(heading):
+                lines.extend(paragraphs)
+        lines.append('')
+        return lines
+
+
+class SectionIndex:
+    '''Index of the sections of each document of a linear corpus with <doc> tags,
+    saved next to it. Each line holds the byte offset and length of a document in
+    the corpus, followed by the titles of its sections, separated by tabs. The
+    index lets later section extractions read only the documents that have one of
+    the sections they want.'''
+
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.index_file = open(filename, mode, encoding='utf-8')
+
+    def add(self, offset, length, headings):
+        self.index_file.write('\t'.join([str(offset), str(length)]+headings)+'\n')
+
+    def find(self, section_filter):
+        '''Yield the offset and length of the documents with a section kept by
+        section_filter.'''
+        for l in self.index_file:
+            fields = l.rstrip('\n').split('\t')
+            if any(section_filter.matches(heading) for heading in fields[2:]):
+                yield int(fields[0]), int(fields[1])
+
+    def close(self):
+        self.index_file.close()
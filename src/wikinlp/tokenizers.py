@@ -0,0 +1,108 @@
+import re
+from collections import deque
+from wikiextractor.pools import safe_pool_context
+
+
+class NLTKTokenizer:
+    '''The NLTK word tokenizer. Accurate, but slow.'''
+
+    def __init__(self):
+        from nltk.tokenize import word_tokenize
+        self.word_tokenize = word_tokenize
+
+    def tokenize(self, text):
+        return self.word_tokenize(text)
+
+
+class RegexTokenizer:
+    '''Splits words from punctuation with a single regular expression. Much faster
+    than NLTK, but it knows nothing about clitics or abbreviations.'''
+
+    token_re = re.compile(r'\w+|[^\w\s]')
+
+    def tokenize(self, text):
+        return self.token_re.findall(text)
+
+
+class SPMTokenizer:
+    '''Splits text into the wordpieces of a trained SentencePiece model.'''
+
+    def __init__(self, model_path):
+        import sentencepiece as spm
+        self.sp = spm.SentencePieceProcessor()
+        self.sp.load(model_path)
+
+    def tokenize(self, text):
+        return self.sp.encode_as_pieces(text)
+
+
+#Tokenizers already loaded in this process, by name and model path
+tokenizers = {}
+
+def get_tokenizer(name='nltk', model_path=None):
+    '''Return the tokenizer called name ('nltk', 'regex' or 'spm'), loading it
+    the first time it is asked for in this process. The spm tokenizer needs the
+    path of a SentencePiece model.'''
+    key = (name, model_path)
+    if key not in tokenizers:
+        if name == 'nltk':
+            tokenizers[key] = NLTKTokenizer()
+        elif name == 'regex':
+            tokenizers[key] = RegexTokenizer()
+        elif name == 'spm':
+            if not model_path:
+                raise ValueError("The spm tokenizer needs the path of a SentencePiece model.")
+            tokenizers[key] = SPMTokenizer(model_path)
+        else:
+            raise ValueError("Unknown tokenizer: "+name+". Choose nltk, regex or spm.")
+    return tokenizers[key]
+
+
+class OrderedStage:
+    '''Applies function to batches of items in a pool of processes, and passes
+    the results on to write in the order of the items. function takes a list of
+    items and returns the list of their results, and must be picklable. With a
+    single process, items are processed right away, in this process.
+    The callers of a stage run threads and fork processes of their own (e.g.
+    extract_documents), so the pool is started from safe_pool_context: scripts
+    using several processes must guard their code with if __name__ == '__main__'.'''
+
+    def __init__(self, function, write, processes=1, batch_size=64):
+        self.function = function
+        self.write = write
+        self.batch_size = batch_size if processes > 1 else 1
+        self.batch = []
+        self.pending = deque()
+        self.pool = None
+        if processes > 1:
+            self.pool = safe_pool_context().Pool(processes)
+            self.window = 2 * processes #Batches in flight, so that results do not pile up
+
+    def put(self, item):
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self.submit()
+
+    def submit(self):
+        if not self.batch:
+            return
+        if self.pool is None:
+            self.write_results(self.function(self.batch))
+        else:
+            self.pending.append(self.pool.apply_async(self.function, (self.batch,)))
+            while len(self.pending) > self.window:
+                self.write_results(self.pending.popleft().get())
+        self.batch = []
+
+    def write_results(self, results):
+        for result in results:
+            self.write(result)
+
+    def close(self):
+        self.submit()
+        while self.pending:
+            self.write_results(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None